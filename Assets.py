@@ -0,0 +1,84 @@
+import pygame
+
+ATLAS_WIDTH = 1024      # atlases grow downwards once a row is full
+
+
+class Assets:
+    def __init__(self, directory):
+        self.directory = directory
+
+        self.images = {}    # {filename: surface}, every file is loaded once
+        self.atlases = {}   # {name: surface}
+
+    def load(self, filename):
+        # loads an image in the display's pixel format, needs set_mode first
+        image = self.images.get(filename)
+
+        if image is None:
+            image = pygame.image.load(self.directory / filename)
+            if image.get_flags() & pygame.SRCALPHA:
+                image = image.convert_alpha()
+            else:
+                image = image.convert()
+            self.images[filename] = image
+
+        return image
+
+    def filenames(self, spec):
+        if isinstance(spec, str):
+            yield spec
+        elif isinstance(spec, dict):
+            for value in spec.values():
+                yield from self.filenames(value)
+        else:
+            for value in spec:
+                yield from self.filenames(value)
+
+    def resolve(self, spec, sprites):
+        # spec with every filename replaced by its sprite
+        if isinstance(spec, str):
+            return sprites[spec]
+        elif isinstance(spec, dict):
+            return {key: self.resolve(value, sprites) for key, value in spec.items()}
+
+        return type(spec)(self.resolve(value, sprites) for value in spec)
+
+    def atlas(self, name, spec):
+        # packs the images named in spec into one surface and returns spec
+        # with the filenames replaced by subsurfaces of it. spec is a
+        # filename or a (nested) list, tuple or dict of filenames
+        filenames = list(dict.fromkeys(self.filenames(spec)))
+        images = [self.load(filename) for filename in filenames]
+
+        # shelf packing, the tallest images first
+        order = sorted(range(len(images)), key=lambda i: -images[i].get_height())
+        rects = [None] * len(images)
+        x, y, shelf_h, width = 0, 0, 0, 0
+
+        for i in order:
+            w, h = images[i].get_size()
+
+            if x > 0 and x + w > ATLAS_WIDTH:
+                x, y, shelf_h = 0, y + shelf_h, 0
+
+            rects[i] = pygame.Rect(x, y, w, h)
+            x += w
+            shelf_h = max(shelf_h, h)
+            width = max(width, x)
+
+        atlas = pygame.Surface((max(width, 1), max(y + shelf_h, 1)), pygame.SRCALPHA).convert_alpha()
+        atlas.fill((0, 0, 0, 0))
+
+        sprites = {}
+        for filename, image, rect in zip(filenames, images, rects):
+            # max blending onto the cleared atlas copies the image exactly,
+            # alpha included
+            atlas.blit(image, rect, special_flags=pygame.BLEND_RGBA_MAX)
+            sprites[filename] = atlas.subsurface(rect)
+
+            # the image lives on in the atlas
+            self.images[filename] = sprites[filename]
+
+        self.atlases[name] = atlas
+
+        return self.resolve(spec, sprites)
@@ -1,8 +1,8 @@
 import numpy as np
-import random
-import pygame
 import math
 
+from SpriteCache import spriteCache
+
 GRAVITY = np.array([0., 20.])
 DRAG = .0005
 
@@ -81,15 +81,10 @@ class Cloud:
             self.setLookDirection(-1)
 
     def render(self, screen):
-        sprite = self.sprites[self.anim_cnt]
-
-        if self.lookDirection > 0:
-            sprite = pygame.transform.flip(sprite, True, False)
-
-        sprite = pygame.transform.rotate(sprite, self.anim_rot)
+        sprite = spriteCache.get(self.sprites[self.anim_cnt], self.anim_rot, self.lookDirection > 0)
         renderpos = (self.pos[0] - self.cam.pos_x - sprite.get_width() / 2, self.pos[1] - self.cam.pos_y - sprite.get_height() / 2)
 
-        screen.blit(sprite, renderpos)
+        return screen.blit(sprite, renderpos)
 
     def startBlowing(self, frame_cnt):
         if self.blowing:
@@ -1,15 +1,18 @@
 import cam
 
+import math
 import numpy as np
 import random
-import pygame
+
+from SpriteCache import spriteCache
+from LevelGrid import COLLISION
 
 
 GRAVITY = np.array([0., 16.])
 DRAG = .0005
 COLLISION_RADIUS = 12 # not an actual radius. Half the collision square's height
-COLLISION_TILES = ["#", 'h', 'i', 'j', 'H', 'X', 'Y', 'd', 'b', 'q', 'p', 'l',
-                   '-', '+', 'o', 'u', 'n', 'w', 'm', 'c', 'C', '_']
+MAX_BOUNCES = 4 # walls hit in one update before the rest of the move is dropped
+EPSILON = 1e-6  # touching a tile's edge isn't overlapping it
 
 
 class Feather:
@@ -57,31 +60,26 @@ class Feather:
         self.v -= v_norm * drag_scalar
 
     def updatePosition(self, dt):
-        potential_pos = self.pos + self.v * dt
-
-        # NOTE TO FUTURE SELF: ALWAYS CHECK HORIZ/VERT SEPERATELY!!
+        # moves up to the first wall in the way, bounces off it and goes on
+        # with the rest of dt, so nothing is skipped however long dt is
+        remaining = 1.0
+        for i in range(MAX_BOUNCES):
+            delta = self.v * dt * remaining
+            t, normal = self.sweep(self.pos, delta)
+            self.pos = self.pos + delta * t
 
-        # horizontal check
-        nbr_wall = self.detectWall((potential_pos[0], self.pos[1]))
-        if nbr_wall is not None:
-            if nbr_wall[0] != 0: # left/right wall
-                self.v[0] = -self.v[0] /10  # fudge v to not get stuck in wall
+            if normal is None:
+                break
 
-        # vertical check
-        nbr_wall = self.detectWall((self.pos[0], potential_pos[1]))
-        if nbr_wall is not None:
-            if nbr_wall[1] != 0: # top/bottom wall
-                self.v[1] = -self.v[1] /10  # fudge v to not get stuck in wall
-
-        corrected_pos = self.pos + self.v * dt
-        self.pos = corrected_pos
+            axis = 0 if normal[0] != 0 else 1
+            self.v[axis] = -self.v[axis] / 10  # fudge v to not get stuck in wall
+            remaining *= 1 - t
 
     def render(self, screen):
-        feather = self.feather_sprites[self.anim_cnt]
-        feather = pygame.transform.rotate(feather, self.anim_rot)
+        feather = spriteCache.get(self.feather_sprites[self.anim_cnt], self.anim_rot)
         renderpos = (self.pos[0] - self.cam.pos_x - feather.get_width() / 2, self.pos[1] - self.cam.pos_y - feather.get_height() / 2)
 
-        screen.blit(feather, renderpos)
+        return screen.blit(feather, renderpos)
 
     def getBoundingBox(self, pos=None):
         if pos is None:
@@ -89,29 +87,63 @@ class Feather:
 
         return pos[0] - COLLISION_RADIUS, pos[1] - COLLISION_RADIUS, pos[0] + COLLISION_RADIUS, pos[1] + COLLISION_RADIUS
 
-    def detectWall(self, potential_pos):
-
-        #  0      2
-        #   o----o
-        #   |    |
-        #   |    |
-        #   o----o
-        #  1      3
-
-        collision_point = np.copy(potential_pos)
-        bbox = self.getBoundingBox(collision_point)
-
-        points = [(bbox[0], bbox[1]),
-                  (bbox[0], bbox[3]),
-                  (bbox[2], bbox[1]),
-                  (bbox[2], bbox[3]),
-                  ]
-
-        for px, py in points:
-            x, y = self.cam.worldToGrid(px, py)
-            tile = self.level[y][x]
-            if tile in COLLISION_TILES:
-                xcoord,ycoord = self.cam.worldToGrid(self.pos[0], self.pos[1])
-                return x - xcoord, y - ycoord
-
-        return None
+    def isWall(self, x, y):
+        # outside of the level is wall too
+        if 0 <= x < self.level.lev_w and 0 <= y < self.level.lev_h:
+            return self.level.has(COLLISION, x, y)
+        return True
+
+    def sweep(self, pos, delta):
+        # moves the collision box from pos by delta through the tile grid
+        # (DDA over the tiles its leading edges enter). returns the part of
+        # delta until it touches a wall, 0 to 1, and the wall's normal, or
+        # 1 and None. walls the box already overlaps are ignored
+        x0, y0, x1, y1 = self.getBoundingBox(pos)
+        dx, dy = delta
+
+        # next column/row the box enters and when, in parts of delta
+        if dx > 0:
+            col = int((x1 - EPSILON) // cam.TILE_W) + 1
+            tx = (col * cam.TILE_W - x1) / dx
+        elif dx < 0:
+            col = int((x0 + EPSILON) // cam.TILE_W) - 1
+            tx = ((col + 1) * cam.TILE_W - x0) / dx
+        else:
+            col, tx = 0, math.inf
+
+        if dy > 0:
+            row = int((y1 - EPSILON) // cam.TILE_H) + 1
+            ty = (row * cam.TILE_H - y1) / dy
+        elif dy < 0:
+            row = int((y0 + EPSILON) // cam.TILE_H) - 1
+            ty = ((row + 1) * cam.TILE_H - y0) / dy
+        else:
+            row, ty = 0, math.inf
+
+        step_x = 1 if dx > 0 else -1
+        step_y = 1 if dy > 0 else -1
+
+        while min(tx, ty) <= 1:
+            if tx <= ty:
+                # the rows the box spans when entering the column
+                t = max(tx, 0.0)
+                top = int((y0 + dy * t + EPSILON) // cam.TILE_H)
+                bottom = int((y1 + dy * t - EPSILON) // cam.TILE_H)
+                for y in range(top, bottom + 1):
+                    if self.isWall(col, y):
+                        return t, (-step_x, 0)
+
+                col += step_x
+                tx += cam.TILE_W / abs(dx)
+            else:
+                t = max(ty, 0.0)
+                left = int((x0 + dx * t + EPSILON) // cam.TILE_W)
+                right = int((x1 + dx * t - EPSILON) // cam.TILE_W)
+                for x in range(left, right + 1):
+                    if self.isWall(x, row):
+                        return t, (0, -step_y)
+
+                row += step_y
+                ty += cam.TILE_H / abs(dy)
+
+        return 1.0, None
@@ -0,0 +1,170 @@
+import cam
+
+import numpy as np
+
+from SpriteCache import spriteCache
+from LevelGrid import COLLISION
+from Feather import GRAVITY, DRAG, COLLISION_RADIUS, MAX_BOUNCES, EPSILON
+
+
+class FeatherSwarm:
+    # many feathers at once, same forces as Feather but kept in arrays and
+    # updated in whole-swarm passes instead of one object per feather
+
+    def __init__(self, feather_sprites, _cam, level, positions, seed=None):
+        # positions is an (N, 2) array in world pixels
+        self.cam = _cam
+        self.level = level
+        self.feather_sprites = feather_sprites
+        self.rng = np.random.default_rng(seed)
+
+        self.pos = np.array(positions, dtype=np.float64).reshape(-1, 2)
+        self.v = np.zeros_like(self.pos)
+        n = len(self.pos)
+
+        # started at random, so they don't all flap in step
+        self.anim_cnt = self.rng.integers(0, 8, n)
+        self.anim_dir = self.rng.choice([-1, 1], n)
+        self.anim_speed = 8     # lower means faster
+        self.anim_rot = self.rng.integers(0, 360, n)
+        self.anim_rot_dir = self.rng.choice([-2, 2], n)
+
+        # scratch space reused every frame
+        self.tilePos = np.empty_like(self.pos)
+        self.v_wind = np.empty_like(self.pos)
+
+    def __len__(self):
+        return len(self.pos)
+
+    def update(self, dt, frame_cnt, fluid):
+        self.update_phys(dt, fluid)
+        self.updateAnimationData(frame_cnt)
+
+    def updateAnimationData(self, frame_cnt):
+        n = len(self)
+
+        if frame_cnt % self.anim_speed == 0:
+            self.anim_cnt += self.anim_dir
+            self.anim_cnt %= 8
+
+            self.anim_dir[self.rng.integers(0, 8, n) == 0] *= -1
+
+        self.anim_rot += self.anim_rot_dir
+        self.anim_rot %= 360
+        self.anim_rot_dir[self.rng.integers(0, 60, n) == 0] *= -1
+
+    def update_phys(self, dt, fluid):
+        self.updatePosition(dt)
+        self.v += dt * GRAVITY
+
+        np.divide(self.pos, (cam.TILE_W, cam.TILE_H), out=self.tilePos)
+        fluid.sampleVelocities(self.tilePos, self.v_wind)
+        dv = self.v - self.v_wind * 1000.0
+
+        # drag_scalar * v_norm of Feather, |dv|^2 * DRAG along dv
+        speed = np.sqrt(np.einsum('ij,ij->i', dv, dv))
+        self.v -= dv * (speed * DRAG)[:, None]
+
+    def updatePosition(self, dt):
+        # Feather.updatePosition for every feather at once: move up to the
+        # first wall, bounce off it and go on with the rest of dt
+        remaining = np.ones(len(self))
+        moving = np.arange(len(self))
+
+        for i in range(MAX_BOUNCES):
+            delta = self.v[moving] * (dt * remaining[moving])[:, None]
+            t, normal = self.sweep(self.pos[moving], delta)
+            self.pos[moving] += delta * t[:, None]
+
+            hit = normal.any(axis=1)
+            moving, t, normal = moving[hit], t[hit], normal[hit]
+            if not len(moving):
+                break
+
+            x_wall = normal[:, 0] != 0
+            self.v[moving[x_wall], 0] *= -1 / 10  # fudge v to not get stuck in wall
+            self.v[moving[~x_wall], 1] *= -1 / 10
+            remaining[moving] *= 1 - t
+
+    def isWall(self, x, y):
+        # outside of the level is wall too
+        level = self.level
+        inside = (x >= 0) & (x < level.lev_w) & (y >= 0) & (y < level.lev_h)
+        wall = ~inside
+        wall[inside] = COLLISION[level.ids[y[inside], x[inside]]]
+        return wall
+
+    def sweep(self, pos, delta):
+        # Feather.sweep in lockstep, one column or row per feather and pass.
+        # the box is smaller than a tile, so it spans at most two rows or
+        # columns. returns (N,) parts of delta and (N, 2) normals, 0 if
+        # nothing was hit
+        n = len(pos)
+        x0, y0 = pos[:, 0] - COLLISION_RADIUS, pos[:, 1] - COLLISION_RADIUS
+        x1, y1 = pos[:, 0] + COLLISION_RADIUS, pos[:, 1] + COLLISION_RADIUS
+        dx, dy = delta[:, 0], delta[:, 1]
+        step_x = np.where(dx > 0, 1, -1)
+        step_y = np.where(dy > 0, 1, -1)
+
+        # next column/row the box enters and when, in parts of delta
+        col = np.where(dx > 0, np.floor_divide(x1 - EPSILON, cam.TILE_W) + 1,
+                               np.floor_divide(x0 + EPSILON, cam.TILE_W) - 1).astype(np.intp)
+        row = np.where(dy > 0, np.floor_divide(y1 - EPSILON, cam.TILE_H) + 1,
+                               np.floor_divide(y0 + EPSILON, cam.TILE_H) - 1).astype(np.intp)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tx = np.where(dx != 0, (np.where(dx > 0, col * cam.TILE_W - x1, (col + 1) * cam.TILE_W - x0)) / dx, np.inf)
+            ty = np.where(dy != 0, (np.where(dy > 0, row * cam.TILE_H - y1, (row + 1) * cam.TILE_H - y0)) / dy, np.inf)
+            step_tx = cam.TILE_W / np.abs(dx)
+            step_ty = cam.TILE_H / np.abs(dy)
+
+        t = np.ones(n)
+        normal = np.zeros((n, 2), dtype=np.intp)
+        active = np.flatnonzero(np.minimum(tx, ty) <= 1)
+
+        while len(active):
+            along_x = tx[active] <= ty[active]
+
+            # entering a column, test the rows the box spans
+            i = active[along_x]
+            ti = np.maximum(tx[i], 0.0)
+            top = np.floor_divide(y0[i] + dy[i] * ti + EPSILON, cam.TILE_H).astype(np.intp)
+            bottom = np.floor_divide(y1[i] + dy[i] * ti - EPSILON, cam.TILE_H).astype(np.intp)
+            hit = self.isWall(col[i], top) | self.isWall(col[i], bottom)
+            t[i[hit]] = ti[hit]
+            normal[i[hit], 0] = -step_x[i[hit]]
+            col[i] += step_x[i]
+            tx[i] += step_tx[i]
+            done = i[hit]
+
+            # entering a row, test the columns
+            j = active[~along_x]
+            tj = np.maximum(ty[j], 0.0)
+            left = np.floor_divide(x0[j] + dx[j] * tj + EPSILON, cam.TILE_W).astype(np.intp)
+            right = np.floor_divide(x1[j] + dx[j] * tj - EPSILON, cam.TILE_W).astype(np.intp)
+            hit = self.isWall(left, row[j]) | self.isWall(right, row[j])
+            t[j[hit]] = tj[hit]
+            normal[j[hit], 1] = -step_y[j[hit]]
+            row[j] += step_y[j]
+            ty[j] += step_ty[j]
+
+            done = np.concatenate([done, j[hit]])
+            active = active[~np.isin(active, done)]
+            active = active[np.minimum(tx[active], ty[active]) <= 1]
+
+        return t, normal
+
+    def render(self, screen):
+        # only the feathers on screen, blitted in one go. returns the rects
+        margin = 2 * max(cam.TILE_W, cam.TILE_H)
+        x = self.pos[:, 0] - self.cam.pos_x
+        y = self.pos[:, 1] - self.cam.pos_y
+        w, h = screen.get_size()
+        visible = np.flatnonzero((x > -margin) & (x < w + margin) & (y > -margin) & (y < h + margin))
+
+        blits = []
+        for fx, fy, anim, rot in zip(x[visible].tolist(), y[visible].tolist(),
+                                     self.anim_cnt[visible].tolist(), self.anim_rot[visible].tolist()):
+            feather = spriteCache.get(self.feather_sprites[anim], rot)
+            blits.append((feather, (fx - feather.get_width() / 2, fy - feather.get_height() / 2)))
+
+        return screen.blits(blits)
@@ -1,15 +1,192 @@
 # cython: language_level=3
 
+import os
 import numpy as np
 
-from libc.math cimport floor, sqrt, round
+from libc.math cimport floor, sqrt, round, fabs
 
 cimport cython
-from libc.stdint cimport int8_t, uint32_t
+from cython.parallel cimport prange
+from libc.stdint cimport int8_t, uint8_t, int32_t, uint32_t
+
+cdef enum:
+    VELOCITY_X = 0
+    VELOCITY_Y = 1
+    SMOKE = 2
+
+# the grid is split into square blocks of cells, only blocks with moving
+# air (and a one block border around them) are simulated
+cdef enum:
+    BLOCK_SIZE = 8
+
+# smoke below this density is invisible and doesn't keep a block awake
+cdef double SMOKE_VISIBLE = 0.01
+
+# cell kinds of the multigrid pressure levels
+cdef enum:
+    CELL_SOLID = 0
+    CELL_FLUID = 1
+    CELL_OPEN = 2       # fluid with a fixed pressure of zero, the outer border
+
+SOLVERS = ('sor', 'multigrid')
+
+cdef class PressureLevel:
+    # one grid of the multigrid hierarchy, solves  sum(p_n - p) = b  over the
+    # non solid neighbours n of every fluid cell
+    cdef int width
+    cdef int height
+    cdef double[:, ::1] p
+    cdef double[:, ::1] b
+    cdef double[:, ::1] r
+    cdef int8_t[:, ::1] kind
+
+    def __init__(self, int width, int height):
+        self.width = width
+        self.height = height
+        self.p = np.zeros(shape=(width, height))
+        self.b = np.zeros(shape=(width, height))
+        self.r = np.zeros(shape=(width, height))
+        self.kind = np.zeros(shape=(width, height), dtype=np.int8)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void smooth(self, int sweeps, int threads) noexcept nogil:
+        # red-black Gauss-Seidel
+        cdef double[:, ::1] p = self.p
+        cdef double[:, ::1] b = self.b
+        cdef int8_t[:, ::1] kind = self.kind
+        cdef int w = self.width, h = self.height
+        cdef int sweep, color, x, y, s
+        cdef double sum
+
+        for sweep in range(sweeps):
+            for color in range(2):
+                for y in prange(h, num_threads=threads, schedule='static'):
+                    for x in range((y + color) % 2, w, 2):
+                        if kind[x, y] != CELL_FLUID:
+                            continue
+
+                        s = 0
+                        sum = 0.0
+                        if x > 0 and kind[x - 1, y] != CELL_SOLID:
+                            s = s + 1
+                            sum = sum + p[x - 1, y]
+                        if x < w - 1 and kind[x + 1, y] != CELL_SOLID:
+                            s = s + 1
+                            sum = sum + p[x + 1, y]
+                        if y > 0 and kind[x, y - 1] != CELL_SOLID:
+                            s = s + 1
+                            sum = sum + p[x, y - 1]
+                        if y < h - 1 and kind[x, y + 1] != CELL_SOLID:
+                            s = s + 1
+                            sum = sum + p[x, y + 1]
+
+                        if s > 0:
+                            p[x, y] = (sum - b[x, y]) / s
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef double computeResidual(self, int threads) noexcept nogil:
+        cdef double[:, ::1] p = self.p
+        cdef double[:, ::1] b = self.b
+        cdef double[:, ::1] r = self.r
+        cdef int8_t[:, ::1] kind = self.kind
+        cdef int w = self.width, h = self.height
+        cdef int x, y
+        cdef double lap, residual = 0.0
+
+        for y in prange(h, num_threads=threads, schedule='static'):
+            for x in range(w):
+                r[x, y] = 0.0
+                if kind[x, y] != CELL_FLUID:
+                    continue
+
+                lap = 0.0
+                if x > 0 and kind[x - 1, y] != CELL_SOLID:
+                    lap = lap + p[x - 1, y] - p[x, y]
+                if x < w - 1 and kind[x + 1, y] != CELL_SOLID:
+                    lap = lap + p[x + 1, y] - p[x, y]
+                if y > 0 and kind[x, y - 1] != CELL_SOLID:
+                    lap = lap + p[x, y - 1] - p[x, y]
+                if y < h - 1 and kind[x, y + 1] != CELL_SOLID:
+                    lap = lap + p[x, y + 1] - p[x, y]
+
+                r[x, y] = b[x, y] - lap
+
+        for y in range(h):
+            for x in range(w):
+                if fabs(r[x, y]) > residual:
+                    residual = fabs(r[x, y])
+
+        return residual
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void restrictTo(self, PressureLevel coarse) noexcept nogil:
+        # a coarse cell is open if any of its 2x2 children is (so the coarse
+        # problems keep their boundary and stay non singular), else fluid if
+        # any child is. its right hand side is the sum of the childrens'
+        # residuals, the coarse laplacian has the same unscaled stencil
+        cdef int x, y, cx, cy
+        cdef int8_t k
+
+        for cy in range(coarse.height):
+            for cx in range(coarse.width):
+                coarse.kind[cx, cy] = CELL_SOLID
+                coarse.b[cx, cy] = 0.0
+                coarse.p[cx, cy] = 0.0
+
+        for y in range(self.height):
+            for x in range(self.width):
+                k = self.kind[x, y]
+                cx = x // 2
+                cy = y // 2
+                if k == CELL_OPEN:
+                    coarse.kind[cx, cy] = CELL_OPEN
+                elif k == CELL_FLUID:
+                    if coarse.kind[cx, cy] == CELL_SOLID:
+                        coarse.kind[cx, cy] = CELL_FLUID
+                    coarse.b[cx, cy] += self.r[x, y]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void prolongFrom(self, PressureLevel coarse) noexcept nogil:
+        # bilinear interpolation of the coarse correction, solid coarse cells
+        # don't take part and open ones contribute a correction of zero
+        cdef int x, y, cx, cy, nx, ny, i, ix, iy
+        cdef double wx, wy, weight, sum, total
+
+        for y in range(self.height):
+            for x in range(self.width):
+                if self.kind[x, y] != CELL_FLUID:
+                    continue
+
+                cx = x // 2
+                cy = y // 2
+                nx = cx - 1 if x % 2 == 0 else cx + 1
+                ny = cy - 1 if y % 2 == 0 else cy + 1
+
+                sum = 0.0
+                total = 0.0
+                for i in range(4):
+                    wx = 0.75 if i % 2 == 0 else 0.25
+                    wy = 0.75 if i // 2 == 0 else 0.25
+                    weight = wx * wy
+                    ix = cx if i % 2 == 0 else nx
+                    iy = cy if i // 2 == 0 else ny
+
+                    if ix < 0 or iy < 0 or ix >= coarse.width or iy >= coarse.height:
+                        continue
+                    if coarse.kind[ix, iy] == CELL_SOLID:
+                        continue
+
+                    sum += weight * coarse.p[ix, iy]
+                    total += weight
+
+                if total > 0.0:
+                    self.p[x, y] += sum / total
 
-VELOCITY_X = 0
-VELOCITY_Y = 1
-SMOKE = 2
 
 cdef class Fluid:
     cdef int granularity
@@ -18,164 +195,683 @@ cdef class Fluid:
     cdef double[:, :, ::1] velocity
     cdef int8_t[:, ::1] space
     cdef double[:, ::1] smoke
-    cdef double remainingTime
 
-    def __init__(self, width, height, granularity):
+    # back buffers, swapped with the front buffers after each advection
+    cdef double[:, :, ::1] velocityBack
+    cdef double[:, ::1] smokeBack
+
+    # dye that emitters inject and the wind carries around, blocks with
+    # visible smoke stay awake until it has faded
+    cdef public bint smokeEnabled
+    cdef public double smokeDecay
+
+    # active blocks, see updateBlocks()
+    cdef int blocksX
+    cdef int blocksY
+    cdef uint8_t[:, ::1] blockActive
+    cdef uint8_t[:, ::1] blockMoving
+    cdef int32_t[::1] activeBlocks
+    cdef readonly int numActiveBlocks
+    cdef public bint sparse
+    cdef public double sleepThreshold
+
+    # space restricted to active blocks, inactive cells act like walls
+    cdef int8_t[:, ::1] activeSpace
+    cdef bint spaceDirty
+
+    # per block scratch for the parallel residual and speed reductions
+    cdef double[::1] blockScratch
+
+    # worker threads for the parallel kernels, 0 means one per core
+    cdef int threads
+
+    # fixed substep scheduler
+    cdef double remainingTime
+    cdef public double stepsPerSecond
+    cdef public int maxSubsteps
+
+    # wind emitters (x, y, vx, vy), injected before every substep
+    cdef double[:, ::1] emitters
+    cdef bint blowing
+    cdef double blower[4]
+
+    # pressure solver settings
+    cdef bint multigrid
+    cdef list levels
+    cdef public int preSmooth
+    cdef public int postSmooth
+    cdef public double overRelaxation
+    cdef public double tolerance
+    cdef public int maxIterations
+
+    # solver stats of the last simulate() call
+    cdef readonly int iterations
+    cdef readonly double residual
+    cdef readonly int substeps
+
+    def __init__(self, width, height, granularity, overRelaxation=1.9, tolerance=1e-3, maxIterations=50,
+                 stepsPerSecond=60.0, maxSubsteps=4, numThreads=0, sparse=True, sleepThreshold=1e-3,
+                 solver='sor', smokeEnabled=False, smokeDecay=0.5):
         self.granularity = granularity
         self.width = width * granularity + 2
         self.height = height * granularity + 2
         self.velocity = np.zeros(shape=(self.width, self.height, 2))
         self.space = np.ones(shape=(self.width, self.height), dtype=np.int8)
         self.smoke = np.zeros(shape=(self.width, self.height))
+        self.velocityBack = np.zeros(shape=(self.width, self.height, 2))
+        self.smokeBack = np.zeros(shape=(self.width, self.height))
+        self.smokeEnabled = smokeEnabled
+        self.smokeDecay = smokeDecay
+        self.activeSpace = np.zeros(shape=(self.width, self.height), dtype=np.int8)
+        self.spaceDirty = False
+
+        self.blocksX = (self.width + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.blocksY = (self.height + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.blockActive = np.zeros(shape=(self.blocksX, self.blocksY), dtype=np.uint8)
+        self.blockMoving = np.zeros(shape=(self.blocksX, self.blocksY), dtype=np.uint8)
+        self.activeBlocks = np.zeros(shape=self.blocksX * self.blocksY, dtype=np.int32)
+        self.blockScratch = np.zeros(shape=self.blocksX * self.blocksY)
+        self.numActiveBlocks = 0
+        self.sparse = sparse
+        self.sleepThreshold = sleepThreshold
+        self.numThreads = numThreads
         self.remainingTime = 0.0
-
-    cdef float conv_coord(self, float v):
+        self.stepsPerSecond = stepsPerSecond
+        self.maxSubsteps = maxSubsteps
+
+        self.emitters = np.zeros(shape=(0, 4))
+        self.blowing = False
+
+        self.solver = solver
+        self.levels = None
+        self.preSmooth = 2
+        self.postSmooth = 2
+        self.overRelaxation = overRelaxation
+        self.tolerance = tolerance
+        self.maxIterations = maxIterations
+        self.iterations = 0
+        self.residual = 0.0
+        self.substeps = 0
+
+    @property
+    def numThreads(self):
+        return self.threads
+
+    @numThreads.setter
+    def numThreads(self, int n):
+        if n <= 0:
+            n = os.cpu_count() or 1
+        self.threads = n
+
+    @property
+    def solver(self):
+        return SOLVERS[self.multigrid]
+
+    @solver.setter
+    def solver(self, name):
+        if name not in SOLVERS:
+            raise ValueError(f"unknown pressure solver {name!r}, expected one of {SOLVERS}")
+        self.multigrid = name == 'multigrid'
+
+    cdef float conv_coord(self, float v) noexcept nogil:
         return v * self.granularity + 1
 
-    def setSpace(self, int x, int y, s):
-        x0 = x * self.granularity + 1 - self.granularity // 2
-        y0 = y * self.granularity + 1 - self.granularity // 2
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def setSpace(self, int x, int y, int s):
+        # marks tile (x, y) as air (1) or solid (0)
+        cdef int x0 = x * self.granularity + 1
+        cdef int y0 = y * self.granularity + 1
+        cdef int dx, dy
+
+        if x < 0 or y < 0 or x0 + self.granularity > self.width - 1 or y0 + self.granularity > self.height - 1:
+            raise IndexError(f"tile ({x}, {y}) is outside of the fluid grid")
 
         for dx in range(self.granularity):
             for dy in range(self.granularity):
-                self.space[x0 + dx, y0 + dx] = s
+                self.space[x0 + dx, y0 + dy] = s
+
+                if s == 0:
+                    self.velocity[x0 + dx, y0 + dy, 0] = 0.0
+                    self.velocity[x0 + dx, y0 + dy, 1] = 0.0
+                    self.velocity[x0 + dx + 1, y0 + dy, 0] = 0.0
+                    self.velocity[x0 + dx, y0 + dy + 1, 1] = 0.0
+
+        self.spaceDirty = True
+
+    def setSpaceMask(self, mask):
+        # sets the whole level at once from a (width, height) boolean tile
+        # mask, True is air and False is solid
+        cdef int g = self.granularity
+        mask = np.asarray(mask, dtype=bool)
 
-    def setBlockVelocity(self, int x, int y, v):
-        x0 = x * self.granularity + 1
-        y0 = y * self.granularity + 1
+        if mask.shape != ((self.width - 2) // g, (self.height - 2) // g):
+            raise ValueError(f"mask must have shape {((self.width - 2) // g, (self.height - 2) // g)}, got {mask.shape}")
 
-        for dx in range(self.granularity + 1):
-            for dy in range(self.granularity + 1):
-                self.velocity[x0 + dx, y0 + dy, 0] = v[0]
-                self.velocity[x0 + dx, y0 + dy, 1] = v[1]
+        cells = np.repeat(np.repeat(mask, g, axis=0), g, axis=1)
+
+        space = np.asarray(self.space)
+        space[1:-1, 1:-1] = cells
+
+        # zero the faces of solid cells like clearSolids() does, cell (x, y)
+        # is solid[x + 1, y + 1] so its left and top neighbours are in range
+        solid = np.zeros(shape=(self.width + 1, self.height + 1), dtype=bool)
+        solid[2:-1, 2:-1] = ~cells
+        velocity = np.asarray(self.velocity)
+        velocity[solid[1:, 1:] | solid[:-1, 1:], 0] = 0.0
+        velocity[solid[1:, 1:] | solid[1:, :-1], 1] = 0.0
+
+        self.spaceDirty = True
 
     def setVelocity(self, float x_, float y_, v):
-        v *= self.granularity
+        self.injectVelocity(x_, y_, v[0], v[1])
 
+    cdef void injectVelocity(self, float x_, float y_, double vx, double vy):
         cdef int x = <int>floor(self.conv_coord(x_) + 0.5)
         cdef int y = <int>floor(self.conv_coord(y_))
-        self.velocity[x, y, 0] = v[0]
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.wakeBlock(x // BLOCK_SIZE, y // BLOCK_SIZE)
+            self.velocity[x, y, 0] = vx * self.granularity
 
         x = <int>floor(self.conv_coord(x_))
         y = <int>floor(self.conv_coord(y_) + 0.5)
-        self.velocity[x, y, 1] = v[1]
+        if 0 <= x < self.width and 0 <= y < self.height:
+            self.wakeBlock(x // BLOCK_SIZE, y // BLOCK_SIZE)
+            self.velocity[x, y, 1] = vy * self.granularity
+
+        if self.smokeEnabled:
+            x = <int>floor(self.conv_coord(x_))
+            y = <int>floor(self.conv_coord(y_))
+            if 0 <= x < self.width and 0 <= y < self.height:
+                self.wakeBlock(x // BLOCK_SIZE, y // BLOCK_SIZE)
+                self.smoke[x, y] = 1.0
+
+    @property
+    def smokeTiles(self):
+        # smoke density per tile as a (width, height) array in tiles
+        cdef int g = self.granularity
+        smoke = np.asarray(self.smoke)[1:-1, 1:-1]
+        if g == 1:
+            return smoke
+
+        w, h = smoke.shape
+        return smoke.reshape(w // g, g, h // g, g).mean(axis=(1, 3))
+
+    def clearSmoke(self):
+        self.smoke[:, :] = 0.0
+        self.smokeBack[:, :] = 0.0
+
+    @property
+    def activeBlockMask(self):
+        return np.asarray(self.blockActive).copy()
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void wakeBlock(self, int bx, int by) noexcept nogil:
+        self.blockMoving[bx, by] = 1
+
+        if not self.blockActive[bx, by]:
+            self.blockActive[bx, by] = 1
+            self.copyBlockSpace(bx, by)
+            self.activeBlocks[self.numActiveBlocks] = by * self.blocksX + bx
+            self.numActiveBlocks += 1
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void copyBlockSpace(self, int bx, int by) noexcept nogil:
+        cdef int x, y
+        for x in range(bx * BLOCK_SIZE, min(bx * BLOCK_SIZE + BLOCK_SIZE, self.width)):
+            for y in range(by * BLOCK_SIZE, min(by * BLOCK_SIZE + BLOCK_SIZE, self.height)):
+                self.activeSpace[x, y] = self.space[x, y]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void sleepBlock(self, int bx, int by) noexcept nogil:
+        # inactive blocks must be identical in the front and back buffers,
+        # the velocity is (nearly) zero anyway and the smoke stays where it is
+        cdef int x, y
+        for x in range(bx * BLOCK_SIZE, min(bx * BLOCK_SIZE + BLOCK_SIZE, self.width)):
+            for y in range(by * BLOCK_SIZE, min(by * BLOCK_SIZE + BLOCK_SIZE, self.height)):
+                self.activeSpace[x, y] = 0
+                self.velocity[x, y, 0] = 0.0
+                self.velocity[x, y, 1] = 0.0
+                self.velocityBack[x, y, 0] = 0.0
+                self.velocityBack[x, y, 1] = 0.0
+                self.smokeBack[x, y] = self.smoke[x, y]
+
+        self.blockActive[bx, by] = 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void updateBlocks(self) noexcept nogil:
+        cdef double[:, :, ::1] vel = self.velocity
+        cdef double[:, ::1] smoke = self.smoke
+        cdef int32_t[::1] activeBlocks = self.activeBlocks
+        cdef double[::1] blockSpeed = self.blockScratch
+        cdef int w = self.width, h = self.height
+        cdef int i, b, bx, by, nx, ny, x, y
+        cdef bint active
+
+        # fastest face velocity of every active block, smoke counts as moving
+        for i in prange(self.numActiveBlocks, num_threads=self.threads, schedule='static'):
+            b = activeBlocks[i]
+            blockSpeed[i] = 0.0
+            for x in range((b % self.blocksX) * BLOCK_SIZE, min((b % self.blocksX) * BLOCK_SIZE + BLOCK_SIZE, w)):
+                for y in range((b // self.blocksX) * BLOCK_SIZE, min((b // self.blocksX) * BLOCK_SIZE + BLOCK_SIZE, h)):
+                    if fabs(vel[x, y, 0]) > blockSpeed[i]:
+                        blockSpeed[i] = fabs(vel[x, y, 0])
+                    if fabs(vel[x, y, 1]) > blockSpeed[i]:
+                        blockSpeed[i] = fabs(vel[x, y, 1])
+                    if self.smokeEnabled and smoke[x, y] >= SMOKE_VISIBLE and self.sleepThreshold > blockSpeed[i]:
+                        blockSpeed[i] = self.sleepThreshold
+
+        for i in range(self.numActiveBlocks):
+            b = activeBlocks[i]
+            if blockSpeed[i] >= self.sleepThreshold:
+                self.blockMoving[b % self.blocksX, b // self.blocksX] = 1
+
+        # moving blocks keep their neighbours awake, so the flow can spread
+        self.numActiveBlocks = 0
+        for by in range(self.blocksY):
+            for bx in range(self.blocksX):
+                active = not self.sparse
+                for nx in range(max(bx - 1, 0), min(bx + 2, self.blocksX)):
+                    for ny in range(max(by - 1, 0), min(by + 2, self.blocksY)):
+                        if self.blockMoving[nx, ny]:
+                            active = True
+
+                if active and not self.blockActive[bx, by]:
+                    self.blockActive[bx, by] = 1
+                    self.copyBlockSpace(bx, by)
+                elif not active and self.blockActive[bx, by]:
+                    self.sleepBlock(bx, by)
+
+                if active:
+                    activeBlocks[self.numActiveBlocks] = by * self.blocksX + bx
+                    self.numActiveBlocks += 1
+
+        self.blockMoving[:, :] = 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void updateActiveSpace(self) noexcept nogil:
+        cdef int i, b
+        for i in range(self.numActiveBlocks):
+            b = self.activeBlocks[i]
+            self.copyBlockSpace(b % self.blocksX, b // self.blocksX)
+
+        self.spaceDirty = False
+
+    def setEmitters(self, emitters):
+        self.emitters = np.array(emitters, dtype=np.float64).reshape(-1, 4)
+
+    def setBlower(self, float x, float y, v):
+        self.blowing = True
+        self.blower[0] = x
+        self.blower[1] = y
+        self.blower[2] = v[0]
+        self.blower[3] = v[1]
+
+    def clearBlower(self):
+        self.blowing = False
+
+    cdef injectEmitters(self):
+        cdef int i
+        for i in range(self.emitters.shape[0]):
+            self.injectVelocity(self.emitters[i, 0], self.emitters[i, 1], self.emitters[i, 2], self.emitters[i, 3])
+
+        if self.blowing:
+            self.injectVelocity(self.blower[0], self.blower[1], self.blower[2], self.blower[3])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef int solveIncompressibility(self, int maxIterations) noexcept nogil:
+        # red-black SOR: cells of one colour never share a face, so the
+        # blocks of a half sweep can be relaxed in parallel
+        cdef double[:, :, ::1] vel = self.velocity
+        cdef int8_t[:, ::1] space = self.activeSpace
+        cdef int32_t[::1] activeBlocks = self.activeBlocks
+        cdef double[::1] blockResidual = self.blockScratch
+        cdef double omega = self.overRelaxation
+        cdef int w = self.width, h = self.height
+        cdef double div, p, residual = 0.0
+        cdef int it, color, i, b, x0, y0, x, y, s
+
+        for it in range(maxIterations):
+            for color in range(2):
+                for i in prange(self.numActiveBlocks, num_threads=self.threads, schedule='static'):
+                    if color == 0:
+                        blockResidual[i] = 0.0
+
+                    b = activeBlocks[i]
+                    x0 = max((b % self.blocksX) * BLOCK_SIZE, 1)
+                    y0 = max((b // self.blocksX) * BLOCK_SIZE, 1)
+
+                    for y in range(y0, min((b // self.blocksX) * BLOCK_SIZE + BLOCK_SIZE, h - 1)):
+                        for x in range(x0 + (x0 + y + color) % 2, min((b % self.blocksX) * BLOCK_SIZE + BLOCK_SIZE, w - 1), 2):
+                            if space[x, y] == 0:
+                                continue
+
+                            s = (space[x - 1, y] + space[x, y - 1]
+                               + space[x + 1, y] + space[x, y + 1])
+
+                            if s == 0:
+                                continue
+
+                            div = (vel[x + 1, y, 0] - vel[x, y, 0]
+                                 + vel[x, y + 1, 1] - vel[x, y, 1])
+
+                            if fabs(div) > blockResidual[i]:
+                                blockResidual[i] = fabs(div)
+
+                            p = -div / s * omega
+
+                            vel[x, y, 0] -= space[x - 1, y] * p
+                            vel[x + 1, y, 0] += space[x + 1, y] * p
+                            vel[x, y, 1] -= space[x, y - 1] * p
+                            vel[x, y + 1, 1] += space[x, y + 1] * p
+
+            residual = 0.0
+            for i in range(self.numActiveBlocks):
+                if blockResidual[i] > residual:
+                    residual = blockResidual[i]
+
+            if residual < self.tolerance:
+                self.residual = residual
+                return it + 1
+
+        self.residual = residual
+        return maxIterations
+
+    cdef buildLevels(self):
+        cdef int w = self.width, h = self.height
+        self.levels = [PressureLevel(w, h)]
+        while w > 4 and h > 4:
+            w = (w + 1) // 2
+            h = (h + 1) // 2
+            self.levels.append(PressureLevel(w, h))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void prepareMultigrid(self, PressureLevel fine) noexcept nogil:
+        # cell kinds and velocity divergence of the finest level, the outer
+        # border keeps a pressure of zero like in the SOR solver
+        cdef double[:, :, ::1] vel = self.velocity
+        cdef int8_t[:, ::1] space = self.activeSpace
+        cdef int w = self.width, h = self.height
+        cdef int x, y
 
-    cdef solveIncompressibility(self):
-        cdef int x, y, s
+        for y in prange(h, num_threads=self.threads, schedule='static'):
+            for x in range(w):
+                fine.p[x, y] = 0.0
+                fine.b[x, y] = 0.0
+
+                if space[x, y] == 0:
+                    fine.kind[x, y] = CELL_SOLID
+                elif x == 0 or y == 0 or x == w - 1 or y == h - 1:
+                    fine.kind[x, y] = CELL_OPEN
+                else:
+                    fine.kind[x, y] = CELL_FLUID
+                    fine.b[x, y] = (vel[x + 1, y, 0] - vel[x, y, 0]
+                                  + vel[x, y + 1, 1] - vel[x, y, 1])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void applyPressure(self, PressureLevel fine) noexcept nogil:
+        cdef double[:, :, ::1] vel = self.velocity
+        cdef double[:, ::1] p = fine.p
+        cdef int8_t[:, ::1] kind = fine.kind
+        cdef int w = self.width, h = self.height
+        cdef int x, y
 
-        for y in range(1, self.height - 1):
-            for x in range(1, self.width - 1):
-                if self.space[x, y] == 0:
+        for y in prange(h, num_threads=self.threads, schedule='static'):
+            for x in range(w):
+                if kind[x, y] == CELL_SOLID:
                     continue
 
-                s = (self.space[x - 1, y] + self.space[x, y - 1]
-                   + self.space[x + 1, y] + self.space[x, y + 1])
+                if x > 0 and kind[x - 1, y] != CELL_SOLID and (kind[x, y] == CELL_FLUID or kind[x - 1, y] == CELL_FLUID):
+                    vel[x, y, 0] -= p[x, y] - p[x - 1, y]
 
-                if s == 0:
-                    continue
+                if y > 0 and kind[x, y - 1] != CELL_SOLID and (kind[x, y] == CELL_FLUID or kind[x, y - 1] == CELL_FLUID):
+                    vel[x, y, 1] -= p[x, y] - p[x, y - 1]
+
+    cdef void vCycle(self, int i):
+        cdef PressureLevel level = self.levels[i]
+        cdef PressureLevel coarse
 
-                p = (self.velocity[x + 1, y, 0] - self.velocity[x, y, 0]
-                   + self.velocity[x, y + 1, 1] - self.velocity[x, y, 1]) / -s
+        if i == len(self.levels) - 1:
+            level.smooth(50, self.threads)
+            return
 
-                overRelaxation = 1.9
-                #p *= overRelaxation
+        coarse = self.levels[i + 1]
 
-                self.velocity[x, y, 0] -= self.space[x - 1, y] * p
-                self.velocity[x + 1, y, 0] += self.space[x + 1, y] * p
-                self.velocity[x, y, 1] -= self.space[x, y - 1] * p
-                self.velocity[x, y + 1, 1] += self.space[x, y + 1] * p
+        level.smooth(self.preSmooth, self.threads)
+        level.computeResidual(self.threads)
+        level.restrictTo(coarse)
+        self.vCycle(i + 1)
+        level.prolongFrom(coarse)
+        level.smooth(self.postSmooth, self.threads)
 
-    cdef extrapolate(self):
+    cdef int solveMultigrid(self, int maxCycles):
+        # geometric multigrid V-cycles on the pressure poisson equation
+        cdef PressureLevel fine
+        cdef double residual = 0.0
+        cdef int cycles = 0
+
+        if self.levels is None:
+            self.buildLevels()
+
+        fine = self.levels[0]
+        self.prepareMultigrid(fine)
+
+        # counted like the SOR iterations, the cycle that gets below the
+        # tolerance is included
+        while cycles < maxCycles:
+            self.vCycle(0)
+            cycles += 1
+
+            residual = fine.computeResidual(self.threads)
+            if residual < self.tolerance:
+                break
+
+        self.residual = residual
+        self.applyPressure(fine)
+        return cycles
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void extrapolate(self) noexcept nogil:
+        cdef double[:, :, ::1] vel = self.velocity
+        cdef int w = self.width, h = self.height
+
+        # only touch active blocks, inactive ones have to stay untouched
         cdef int x
-        for x in range(self.width):
-            self.velocity[x, 0, 0] = self.velocity[x, 1, 0]
-            self.velocity[x, -1, 0] = self.velocity[x, -2, 0]
+        for x in range(w):
+            if self.blockActive[x // BLOCK_SIZE, 0]:
+                vel[x, 0, 0] = vel[x, 1, 0]
+            if self.blockActive[x // BLOCK_SIZE, (h - 1) // BLOCK_SIZE]:
+                vel[x, h - 1, 0] = vel[x, h - 2, 0]
 
         cdef int y
-        for y in range(self.height):
-            self.velocity[0, y, 1] = self.velocity[1, y, 1]
-            self.velocity[-1, y, 1] = self.velocity[-2, y, 1]
-
-    cdef float avgVelocityX(self, int x, int y):
+        for y in range(h):
+            if self.blockActive[0, y // BLOCK_SIZE]:
+                vel[0, y, 1] = vel[1, y, 1]
+            if self.blockActive[(w - 1) // BLOCK_SIZE, y // BLOCK_SIZE]:
+                vel[w - 1, y, 1] = vel[w - 2, y, 1]
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef float avgVelocityX(self, int x, int y) noexcept nogil:
         return (self.velocity[x, y - 1, 0] + self.velocity[x, y, 0]
               + self.velocity[x + 1, y - 1, 0] + self.velocity[x + 1, y, 0]) / 4.0
 
-    cdef float avgVelocityY(self, int x, int y):
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef float avgVelocityY(self, int x, int y) noexcept nogil:
         return (self.velocity[x - 1, y, 1] + self.velocity[x, y, 1]
               + self.velocity[x - 1, y + 1, 1] + self.velocity[x, y + 1, 1]) / 4.0
 
-    cdef advectVelocity(self, float dt):
-        newVelocity = self.velocity.copy()
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void advectVelocity(self, float dt) noexcept nogil:
+        cdef double[:, :, ::1] vel = self.velocity
+        cdef double[:, :, ::1] newVelocity = self.velocityBack
+        cdef int8_t[:, ::1] space = self.activeSpace
+        cdef int32_t[::1] activeBlocks = self.activeBlocks
+        cdef int w = self.width, h = self.height
 
         cdef float damping = 0.95
+        cdef float nx, ny
+
+        cdef int i, b, x, y
+        for i in prange(self.numActiveBlocks, num_threads=self.threads, schedule='static'):
+            b = activeBlocks[i]
+            for y in range((b // self.blocksX) * BLOCK_SIZE, min((b // self.blocksX) * BLOCK_SIZE + BLOCK_SIZE, h)):
+                for x in range((b % self.blocksX) * BLOCK_SIZE, min((b % self.blocksX) * BLOCK_SIZE + BLOCK_SIZE, w)):
+                    # the back buffer holds stale data, so every cell is written
+                    newVelocity[x, y, 0] = vel[x, y, 0]
+                    newVelocity[x, y, 1] = vel[x, y, 1]
+
+                    if x == 0 or y == 0:
+                        continue
+
+                    if space[x, y] and space[x - 1, y] and y < h - 1:
+                        nx = x - dt * vel[x, y, 0]
+                        ny = (y + 0.5) - dt * self.avgVelocityY(x, y)
+                        newVelocity[x, y, 0] = self.sampleField(nx, ny, VELOCITY_X) * damping
+
+                    if space[x, y] and space[x, y - 1] and x < w - 1:
+                        nx = (x + 0.5) - dt * self.avgVelocityX(x, y)
+                        ny = y - dt * vel[x, y, 1]
+                        newVelocity[x, y, 1] = self.sampleField(nx, ny, VELOCITY_Y) * damping
+
+        self.velocity, self.velocityBack = self.velocityBack, self.velocity
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void advectSmoke(self, float dt) noexcept nogil:
+        cdef double[:, :, ::1] vel = self.velocity
+        cdef double[:, ::1] smoke = self.smoke
+        cdef double[:, ::1] newSmoke = self.smokeBack
+        cdef int8_t[:, ::1] space = self.activeSpace
+        cdef int32_t[::1] activeBlocks = self.activeBlocks
+        cdef int w = self.width, h = self.height
+
+        cdef float u, v, x_, y_
+        cdef double fade = max(0.0, 1.0 - self.smokeDecay * dt)
+
+        cdef int i, b, x, y
+        for i in prange(self.numActiveBlocks, num_threads=self.threads, schedule='static'):
+            b = activeBlocks[i]
+            for x in range((b % self.blocksX) * BLOCK_SIZE, min((b % self.blocksX) * BLOCK_SIZE + BLOCK_SIZE, w)):
+                for y in range((b // self.blocksX) * BLOCK_SIZE, min((b // self.blocksX) * BLOCK_SIZE + BLOCK_SIZE, h)):
+                    newSmoke[x, y] = smoke[x, y]
+
+                    if x == 0 or y == 0 or x == w - 1 or y == h - 1:
+                        continue
+
+                    if space[x, y] == 0:
+                        continue
+
+                    u = (vel[x, y, 0] + vel[x + 1, y, 0]) * 0.5
+                    v = (vel[x, y, 1] + vel[x, y + 1, 1]) * 0.5
+                    x_ = x + 0.5 - dt * u
+                    y_ = y + 0.5 - dt * v
+
+                    newSmoke[x, y] = self.sampleField(x_, y_, SMOKE) * fade
+
+        self.smoke, self.smokeBack = self.smokeBack, self.smoke
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef void clearSolids(self) noexcept nogil:
+        cdef double[:, :, ::1] vel = self.velocity
+        cdef int8_t[:, ::1] space = self.space
+        cdef int32_t[::1] activeBlocks = self.activeBlocks
+        cdef int w = self.width, h = self.height
+
+        # neighbouring blocks may both zero the same face, which is harmless
+        cdef int i, b, x, y
+        for i in prange(self.numActiveBlocks, num_threads=self.threads, schedule='static'):
+            b = activeBlocks[i]
+            for y in range((b // self.blocksX) * BLOCK_SIZE, min((b // self.blocksX) * BLOCK_SIZE + BLOCK_SIZE, h)):
+                for x in range((b % self.blocksX) * BLOCK_SIZE, min((b % self.blocksX) * BLOCK_SIZE + BLOCK_SIZE, w)):
+                    if space[x, y] == 0:
+                        vel[x, y, 0] = 0.0
+                        vel[x, y, 1] = 0.0
+                        if x + 1 < w:
+                            vel[x + 1, y, 0] = 0.0
+                        if y + 1 < h:
+                            vel[x, y + 1, 1] = 0.0
+
+    cdef int step(self, float dt):
+        cdef int iterations
+
+        self.injectEmitters()
+
+        with nogil:
+            if self.spaceDirty:
+                self.updateActiveSpace()
+
+            self.clearSolids()
+
+        if self.multigrid:
+            iterations = self.solveMultigrid(self.maxIterations)
+        else:
+            with nogil:
+                iterations = self.solveIncompressibility(self.maxIterations)
 
-        cdef int x, y
-        for y in range(1, self.height):
-            for x in range(1, self.width):
-                if self.space[x, y] and self.space[x - 1, y] and y < self.height - 1:
-                    nx = x - dt * self.velocity[x, y, 0]
-                    ny = (y + 0.5) - dt * self.avgVelocityY(x, y)
-                    newVelocity[x, y, 0] = self.sampleField(nx, ny, VELOCITY_X) * damping
-
-                if self.space[x, y] and self.space[x, y - 1] and x < self.width - 1:
-                    nx = (x + 0.5) - dt * self.avgVelocityX(x, y)
-                    ny = y - dt * self.velocity[x, y, 1]
-                    newVelocity[x, y, 1] = self.sampleField(nx, ny, VELOCITY_Y) * damping
-
-        self.velocity = newVelocity
-
-    cdef advectSmoke(self, float dt):
-        newSmoke = self.smoke.copy()
-
-        for x in range(1, self.width - 1):
-            for y in range(1, self.height - 1):
-                if self.space[x, y] == 0:
-                    continue
-
-                u = self.velocity[x, y, 0] + self.velocity[x + 1, y, 0] * 0.5
-                v = self.velocity[x, y, 1] + self.velocity[x, y + 1, 1] * 0.5
-                x_ = x + 0.5 - dt * u
-                y_ = y + 0.5 - dt * v
+        with nogil:
+            self.extrapolate()
+            self.advectVelocity(dt)
+            if self.smokeEnabled:
+                self.advectSmoke(dt)
+            self.updateBlocks()
 
-                newSmoke[x, y] = self.sampleField(x_, y_, SMOKE)
+        return iterations
 
-        self.smoke = newSmoke
+    def simulate(self, double dt):
+        cdef double h = 1.0 / self.stepsPerSecond
+        cdef int i, steps
 
-    def simulate(self, dt):
-        stepsPerSecond = 100
+        self.remainingTime += dt
+        steps = <int>(self.remainingTime / h)
 
-        steps = int((dt + self.remainingTime) * stepsPerSecond)
-        self.remainingTime = (dt + self.remainingTime) - steps / stepsPerSecond
+        if steps > self.maxSubsteps:
+            # drop the time we can't catch up on, so a slow frame doesn't
+            # make the next frame even slower
+            steps = self.maxSubsteps
+            self.remainingTime = steps * h
 
-        cdef int x, y
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.space[x, y] == 0:
-                    if self.velocity[x, y, 0] != 0.0:
-                        self.velocity[x, y, 0] = 0.0
-                    if self.velocity[x, y, 1] != 0.0:
-                        self.velocity[x, y, 1] = 0.0
-                    if x + 1 < self.width and self.velocity[x + 1, y, 0] != 0.0:
-                        self.velocity[x + 1, y, 0] = 0.0
-                    if y + 1 < self.height and self.velocity[x, y + 1, 1] != 0.0:
-                        self.velocity[x, y + 1, 1] = 0.0
+        self.remainingTime -= steps * h
 
+        self.iterations = 0
         for i in range(steps):
-            self.solveIncompressibility()
-        self.extrapolate()
-        self.advectVelocity(dt)
-        #self.advectSmoke(dt)
+            self.iterations += self.step(h)
+        self.substeps = steps
 
-    cdef float sampleField(self, float x, float y, field):
-        cdef uint32_t x0, y0
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef float sampleField(self, float x, float y, int field) noexcept nogil:
+        cdef uint32_t x0, y0, x1, y1
+        cdef float tx, ty, sx, sy
 
         x = max(1, min(x, self.width - 0.001))
         y = max(1, min(y, self.height - 0.001))
 
         if field == VELOCITY_X:
             y -= 0.5
+        elif field == VELOCITY_Y:
+            x -= 0.5
         else:
             x -= 0.5
+            y -= 0.5
 
         x0 = <uint32_t>floor(x)
         y0 = <uint32_t>floor(y)
@@ -186,14 +882,18 @@ cdef class Fluid:
         sx = 1.0 - tx
         sy = 1.0 - ty
 
+        if field == SMOKE:
+            return (sx*sy * self.smoke[x0, y0] +
+                    tx*sy * self.smoke[x1, y0] +
+                    tx*ty * self.smoke[x1, y1] +
+                    sx*ty * self.smoke[x0, y1])
+
         return (sx*sy * self.velocity[x0, y0, field] +
                 tx*sy * self.velocity[x1, y0, field] +
                 tx*ty * self.velocity[x1, y1, field] +
                 sx*ty * self.velocity[x0, y1, field])
 
     cpdef (float, float) sampleVelocity(self, float x, float y):
-        cdef uint32_t x0, y0
-
         x = self.conv_coord(x)
         y = self.conv_coord(y)
 
@@ -202,27 +902,115 @@ cdef class Fluid:
 
         return (u / self.granularity, v / self.granularity)
 
-    def getStreamLine(self, float x, float y, int maxSegments, float minSpeed):
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def sampleVelocities(self, const double[:, ::1] points, double[:, ::1] out=None):
+        # batched sampleVelocity, points and out are (N, 2) arrays in tiles
+        cdef Py_ssize_t i, n = points.shape[0]
+        cdef float x, y
+
+        if points.shape[1] != 2:
+            raise ValueError(f"points must have shape (N, 2), got ({n}, {points.shape[1]})")
+
+        if out is None:
+            out = np.empty(shape=(n, 2))
+        elif out.shape[0] != n or out.shape[1] != 2:
+            raise ValueError(f"out must have shape ({n}, 2), got ({out.shape[0]}, {out.shape[1]})")
+
+        with nogil:
+            for i in range(n):
+                x = self.conv_coord(points[i, 0])
+                y = self.conv_coord(points[i, 1])
+                out[i, 0] = self.sampleField(x, y, VELOCITY_X) / self.granularity
+                out[i, 1] = self.sampleField(x, y, VELOCITY_Y) / self.granularity
+
+        return np.asarray(out)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    cdef bint isFreeTile(self, double x, double y) noexcept nogil:
+        cdef int cx, cy
+
+        if x < 0.0 or y < 0.0:
+            return False
+
+        cx = <int>floor(self.conv_coord(x))
+        cy = <int>floor(self.conv_coord(y))
+        if cx >= self.width - 1 or cy >= self.height - 1:
+            return False
+
+        return self.space[cx, cy] != 0
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    @cython.cdivision(True)
+    def traceStreamLines(self, const double[:, ::1] seeds, int maxSegments, float minSpeed):
+        # traces a streamline from every (x, y) seed (in tiles) with midpoint
+        # (RK2) steps of constant length. returns the vertices (x, y, speed) of
+        # all lines packed into one (M, 3) array and an offsets array, line i
+        # is vertices[offsets[i]:offsets[i + 1]]
         cdef float segLen = 0.2
-        points = [(x, y, 0)]
+        cdef Py_ssize_t i, n = seeds.shape[0], count = 0
+        cdef int seg
+        cdef double x, y, mx, my, u, v, speed
+        cdef float cx, cy
+
+        if seeds.shape[1] != 2:
+            raise ValueError(f"seeds must have shape (N, 2), got ({n}, {seeds.shape[1]})")
+
+        vertices_ = np.empty(shape=(n * (maxSegments + 1), 3))
+        offsets_ = np.empty(shape=n + 1, dtype=np.intp)
+        cdef double[:, ::1] vertices = vertices_
+        cdef Py_ssize_t[::1] offsets = offsets_
+
+        with nogil:
+            for i in range(n):
+                offsets[i] = count
+                x = seeds[i, 0]
+                y = seeds[i, 1]
+
+                if not self.isFreeTile(x, y):
+                    continue
 
-        if x >= self.width - 2 or y >= self.height - 2:
-            return points
+                vertices[count, 0] = x
+                vertices[count, 1] = y
+                vertices[count, 2] = 0.0
+                count += 1
 
-        for n in range(maxSegments):
-            v_x, v_y = self.sampleVelocity(x, y)
-            v = sqrt(v_x**2 + v_y**2)
+                for seg in range(maxSegments):
+                    cx = self.conv_coord(x)
+                    cy = self.conv_coord(y)
+                    u = self.sampleField(cx, cy, VELOCITY_X) / self.granularity
+                    v = self.sampleField(cx, cy, VELOCITY_Y) / self.granularity
+                    speed = sqrt(u * u + v * v)
 
-            if v < minSpeed or v <= 0.0:
-                break
+                    if speed < minSpeed or speed <= 0.0:
+                        break
 
-            x += v_x / v * segLen
-            y += v_y / v * segLen
-            #x += v_x * 0.01
-            #y += v_y * 0.01
-            if x >= self.width / self.granularity - 2 or y >= self.height / self.granularity - 2:
-                break
+                    # half step, then the full step along the midpoint velocity
+                    mx = x + u / speed * segLen * 0.5
+                    my = y + v / speed * segLen * 0.5
+                    cx = self.conv_coord(mx)
+                    cy = self.conv_coord(my)
+                    u = self.sampleField(cx, cy, VELOCITY_X) / self.granularity
+                    v = self.sampleField(cx, cy, VELOCITY_Y) / self.granularity
+                    speed = sqrt(u * u + v * v)
+
+                    if speed <= 0.0:
+                        break
+
+                    x = x + u / speed * segLen
+                    y = y + v / speed * segLen
+
+                    if not self.isFreeTile(x, y):
+                        break
+
+                    vertices[count, 0] = x
+                    vertices[count, 1] = y
+                    vertices[count, 2] = speed
+                    count += 1
 
-            points.append((x, y, v))
+            offsets[n] = count
 
-        return points
\ No newline at end of file
+        return vertices_[:count], offsets_
\ No newline at end of file
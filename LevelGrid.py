@@ -0,0 +1,165 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+# a tile's ID is the byte of its character in the level file
+
+COLLISION_TILES = "#hijHXYdbqpl-+ounwmcC_"     # stop the feather
+WIND_BLOCKERS = "#dbqpl-+oun"                   # the wind can't blow through these
+ANIMATED_TILES = "F+X"
+GOAL_TILES = "F"                                # the feather wins here
+SPAWN_TILE = "*"
+SWARM_TILE = "~"                                # a handful of swarm feathers start here
+
+CACHE_VERSION = 1       # bump when the compiled contents change
+CACHE_MIN_SIZE = 8192   # smaller files compile faster than the cache loads
+
+# directions the wind comes out of emitter tiles, relative to the tile
+EMITTERS = {
+    'X': [(0, -1)],             # heat grill
+    '+': [(0, -1), (0, +1)],    # pipe grill
+}
+
+
+def propertyTable(tiles):
+    table = np.zeros(256, dtype=bool)
+    table[[ord(tile) for tile in tiles]] = True
+    return table
+
+
+COLLISION = propertyTable(COLLISION_TILES)
+WIND_BLOCKER = propertyTable(WIND_BLOCKERS)
+ANIMATED = propertyTable(ANIMATED_TILES)
+EMITTER = propertyTable(EMITTERS)
+GOAL = propertyTable(GOAL_TILES)
+SPAWN = propertyTable(SPAWN_TILE)
+SWARM = propertyTable(SWARM_TILE)
+
+
+class LevelGrid:
+    def __init__(self, ids, compiled=None):
+        # ids is a (height, width) uint8 array of tile IDs, compiled holds
+        # what precompute() would find, e.g. from the cache
+        self.ids = ids
+        self.lev_h, self.lev_w = ids.shape
+
+        if compiled is None:
+            self.precompute()
+        else:
+            self.solid, self.sources, self.spawn, self.goals = compiled
+
+    def precompute(self):
+        self.solid = self.mask(WIND_BLOCKER)
+        self.sources = self.emitters()
+        spawns = self.find(SPAWN)
+        self.spawn = tuple(spawns[-1].tolist()) if len(spawns) else None
+        self.goals = self.find(GOAL)
+
+    @classmethod
+    def load(cls, path):
+        # loads a .lvl file through its compiled .npz next to it. the cache
+        # is used while the file's mtime and size are unchanged, or its
+        # contents hash the same. small levels are always compiled
+        cachePath = path.with_suffix('.npz')
+        stat = os.stat(path)
+
+        if stat.st_size < CACHE_MIN_SIZE:
+            with open(path, 'rb') as f:
+                return cls.fromLines(f.read().decode('latin-1').splitlines())
+
+        try:
+            with np.load(cachePath) as cache:
+                if int(cache['version']) == CACHE_VERSION:
+                    if float(cache['mtime']) == stat.st_mtime and int(cache['size']) == stat.st_size:
+                        return cls.fromCache(cache)
+
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                    if str(cache['hash']) == hashlib.sha1(data).hexdigest():
+                        level = cls.fromCache(cache)
+                        level.saveCache(cachePath, stat, data)
+                        return level
+        except (OSError, KeyError, ValueError):
+            pass
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        level = cls.fromLines(data.decode('latin-1').splitlines())
+        level.saveCache(cachePath, stat, data)
+
+        return level
+
+    @classmethod
+    def fromCache(cls, cache):
+        spawn = tuple(cache['spawn'].tolist())
+        compiled = (cache['solid'], cache['sources'], spawn if spawn[0] >= 0 else None, cache['goals'])
+        return cls(cache['ids'], compiled)
+
+    def saveCache(self, cachePath, stat, data):
+        # written to a temporary file first, so a crash never leaves half
+        # a cache behind. one per thread, the level loader may be compiling
+        # the same level. read-only installs just go without
+        tmpPath = cachePath.with_name(f"{cachePath.stem}.{threading.get_ident()}.tmp")
+
+        try:
+            with open(tmpPath, 'wb') as f:
+                np.savez(f, version=CACHE_VERSION, mtime=stat.st_mtime, size=stat.st_size,
+                         hash=hashlib.sha1(data).hexdigest(), ids=self.ids, solid=self.solid,
+                         sources=self.sources, goals=self.goals,
+                         spawn=np.array(self.spawn if self.spawn is not None else (-1, -1), dtype=np.int32))
+            os.replace(tmpPath, cachePath)
+        except OSError:
+            pass
+
+    @classmethod
+    def fromLines(cls, lines):
+        # shorter lines are padded with air
+        lev_w = max((len(line) for line in lines), default=0)
+        data = ''.join(line.ljust(lev_w) for line in lines).encode('latin-1')
+        ids = np.frombuffer(data, dtype=np.uint8).reshape(len(lines), lev_w).copy()
+        return cls(ids)
+
+    def lines(self):
+        return [row.tobytes().decode('latin-1') for row in self.ids]
+
+    def tile(self, x, y):
+        return chr(self.ids[y, x])
+
+    def setTile(self, x, y, tile):
+        old = self.ids[y, x]
+        new = ord(tile)
+        self.ids[y, x] = new
+
+        self.solid[y, x] = WIND_BLOCKER[new]
+        if EMITTER[old] or EMITTER[new]:
+            self.sources = self.emitters()
+        if SPAWN[old] or SPAWN[new]:
+            spawns = self.find(SPAWN)
+            self.spawn = tuple(spawns[-1].tolist()) if len(spawns) else None
+        if GOAL[old] or GOAL[new]:
+            self.goals = self.find(GOAL)
+
+    def has(self, table, x, y):
+        # whether the tile at x, y has the property of table, e.g. COLLISION
+        return table[self.ids[y, x]]
+
+    def mask(self, table):
+        # (height, width) bool array of the tiles with the property
+        return table[self.ids]
+
+    def find(self, table):
+        # (N, 2) array of (x, y) of the tiles with the property, in
+        # reading order
+        return np.ascontiguousarray(np.argwhere(table[self.ids])[:, ::-1], dtype=np.int32)
+
+    def emitters(self):
+        # (N, 4) array of (x, y, dx, dy) for every wind source next to an
+        # emitter tile
+        sources = []
+        for x, y in self.find(EMITTER).tolist():
+            for dx, dy in EMITTERS[chr(self.ids[y, x])]:
+                sources.append((x + dx, y + dy, dx, dy))
+        return np.array(sources, dtype=np.int32).reshape(-1, 4)
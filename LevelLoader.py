@@ -0,0 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LevelLoader:
+    # prepares levels on a worker thread ahead of time. prepare(level_i)
+    # must only build new objects, never touch the running game
+
+    def __init__(self, prepare):
+        self.prepare = prepare
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='LevelLoader')
+        self.pending = {}   # {level_i: future}
+
+    def prefetch(self, levels):
+        # starts preparing levels, drops the prepared ones not asked for
+        for level_i in list(self.pending):
+            if level_i not in levels:
+                self.pending.pop(level_i).cancel()
+
+        for level_i in levels:
+            if level_i not in self.pending:
+                self.pending[level_i] = self.executor.submit(self.prepare, level_i)
+
+    def get(self, level_i):
+        # the prepared level, waiting for it if it's still being prepared.
+        # levels nobody asked for are prepared right here. every prepared
+        # level is handed out once
+        future = self.pending.pop(level_i, None)
+        if future is None or future.cancelled():
+            return self.prepare(level_i)
+
+        return future.result()
+
+    def discard(self, level_i):
+        # forgets a prepared level, e.g. because its file changed
+        future = self.pending.pop(level_i, None)
+        if future is not None:
+            future.cancel()
+
+    def close(self):
+        self.pending.clear()
+        self.executor.shutdown(wait=True, cancel_futures=True)
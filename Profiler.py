@@ -0,0 +1,215 @@
+import csv
+import json
+import time
+from collections import deque
+
+import pygame
+
+HISTORY = 600           # frames kept for the overlay and for exporting
+GRAPH_FRAMES = 120      # frames shown in the overlay's graph
+GRAPH_H = 40            # graph height in pixels
+TARGET_MS = 1000 / 60   # the graph's scale line, one frame at 60 fps
+HISTOGRAM_BUCKET = 2    # milliseconds per histogram bar
+HISTOGRAM_BUCKETS = 17  # the last one collects everything slower
+OVERLAY_INTERVAL = 10   # frames between redraws of the overlay
+
+COLORS = [(255, 96, 96), (96, 255, 96), (96, 160, 255), (255, 224, 64),
+          (255, 128, 255), (64, 255, 255), (255, 160, 64), (192, 192, 192)]
+
+
+class Section:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.depth += 1
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        profiler = self.profiler
+        profiler.depth -= 1
+        profiler.events.append((self.name, self.start, end - self.start, profiler.depth))
+
+
+class NullSection:
+    # what sections are while the profiler is off, does nothing
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_SECTION = NullSection()
+
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+
+        # (start, duration, [(name, start, duration, depth)]) per frame
+        self.frames = deque(maxlen=HISTORY)
+        self.frameStart = None
+        self.events = []
+        self.depth = 0
+
+        self.colors = {}
+        self.overlay = None
+        self.overlayAge = 0
+
+    def section(self, name):
+        # use as "with profiler.section('name'):", sections can be nested
+        if not self.enabled:
+            return NULL_SECTION
+
+        return Section(self, name)
+
+    def beginFrame(self):
+        if not self.enabled:
+            self.frameStart = None
+            return
+
+        self.frameStart = time.perf_counter()
+        self.events = []
+        self.depth = 0
+
+    def endFrame(self):
+        if not self.enabled or self.frameStart is None:
+            return
+
+        # sections are recorded when they end, put them back in start order
+        self.events.sort(key=lambda event: event[1])
+        self.frames.append((self.frameStart, time.perf_counter() - self.frameStart, self.events))
+        self.frameStart = None
+
+    def clear(self):
+        self.frames.clear()
+        self.overlay = None
+
+    def color(self, name):
+        if name not in self.colors:
+            self.colors[name] = COLORS[len(self.colors) % len(COLORS)]
+
+        return self.colors[name]
+
+    def averages(self, frames):
+        # average ms per frame of every section, in the order they first ran
+        totals = {}
+        for start, duration, events in frames:
+            for name, s, d, depth in events:
+                key = (name, depth)
+                totals[key] = totals.get(key, 0) + d
+
+        return [(name, depth, total / len(frames) * 1000) for (name, depth), total in totals.items()]
+
+    def histogram(self, frames):
+        counts = [0] * HISTOGRAM_BUCKETS
+        for start, duration, events in frames:
+            i = min(int(duration * 1000 / HISTOGRAM_BUCKET), HISTOGRAM_BUCKETS - 1)
+            counts[i] += 1
+
+        return counts
+
+    def renderOverlay(self, screen, font, pos, width):
+        # rolling breakdown of the last frames, redrawn every few frames.
+        # returns the rect drawn
+        if not self.frames:
+            return None
+
+        self.overlayAge -= 1
+        if self.overlay is None or self.overlayAge <= 0:
+            self.overlay = self.drawOverlay(font, width)
+            self.overlayAge = OVERLAY_INTERVAL
+
+        return screen.blit(self.overlay, pos)
+
+    def drawOverlay(self, font, width):
+        frames = list(self.frames)[-GRAPH_FRAMES:]
+        averages = self.averages(frames)
+        counts = self.histogram(frames)
+
+        hist_h = 24
+        height = 4 + GRAPH_H + 4 + hist_h + 4 + (len(averages) + 1) * font.line_h + 4
+        overlay = pygame.Surface((width, height), pygame.SRCALPHA)
+        overlay.fill((0, 0, 0, 64))
+
+        # stacked top level sections per frame, newest on the right
+        scale = GRAPH_H / (2 * TARGET_MS)
+        x0 = width - 4 - len(frames)
+        for i, (start, duration, events) in enumerate(frames):
+            y = 4 + GRAPH_H
+            for name, s, d, depth in events:
+                if depth > 0:
+                    continue
+
+                h = d * 1000 * scale
+                overlay.fill(self.color(name), (x0 + i, y - h, 1, max(h, 1)))
+                y -= h
+
+        target_y = 4 + GRAPH_H - TARGET_MS * scale
+        pygame.draw.line(overlay, (255, 255, 255), (4, target_y), (width - 5, target_y))
+
+        # frame time histogram, HISTOGRAM_BUCKET ms per bar
+        bar_w = (width - 8) // HISTOGRAM_BUCKETS
+        y = 4 + GRAPH_H + 4 + hist_h
+        most = max(counts)
+        for i, count in enumerate(counts):
+            h = count / most * hist_h
+            color = (96, 255, 96) if (i + 1) * HISTOGRAM_BUCKET <= TARGET_MS + HISTOGRAM_BUCKET else (255, 96, 96)
+            overlay.fill(color, (4 + i * bar_w, y - h, bar_w - 1, h))
+
+        # average ms per frame, nested sections indented
+        ms = sum(duration for start, duration, events in frames) / len(frames) * 1000
+        font.drawText(overlay, 'FRAME %7.2f MS' % ms, x=1, y=(y + 4) / font.line_h, fgcolor=(255, 255, 255))
+        for name, depth, avg in averages:
+            font.drawText(overlay, '%-11s %7.2f' % (' ' * depth + name.upper(), avg))
+            if depth == 0:
+                overlay.fill(self.color(name), (2, (font.lastypos - 1) * font.line_h + 1, 4, font.font_h - 2))
+
+        return overlay
+
+    def exportCsv(self, path):
+        # one row per section of every recorded frame, times in ms since
+        # the first frame. returns whether there was anything to write
+        if not self.frames:
+            return False
+
+        t0 = self.frames[0][0]
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['frame', 'section', 'depth', 'start_ms', 'duration_ms'])
+            for i, (start, duration, events) in enumerate(self.frames):
+                writer.writerow([i, 'frame', -1, '%.4f' % ((start - t0) * 1000), '%.4f' % (duration * 1000)])
+                for name, s, d, depth in events:
+                    writer.writerow([i, name, depth, '%.4f' % ((s - t0) * 1000), '%.4f' % (d * 1000)])
+
+        return True
+
+    def exportChromeTrace(self, path):
+        # for chrome://tracing or https://ui.perfetto.dev, returns whether
+        # there was anything to write
+        if not self.frames:
+            return False
+
+        t0 = self.frames[0][0]
+        events = []
+        for i, (start, duration, sections) in enumerate(self.frames):
+            events.append({'name': 'frame', 'ph': 'X', 'pid': 0, 'tid': 0,
+                           'ts': (start - t0) * 1e6, 'dur': duration * 1e6, 'args': {'frame': i}})
+            for name, s, d, depth in sections:
+                events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                               'ts': (s - t0) * 1e6, 'dur': d * 1e6})
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+        return True
+
+
+# shared by everything that wants to be timed
+profiler = Profiler()
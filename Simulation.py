@@ -0,0 +1,228 @@
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+import cam
+from Cloud import Cloud
+from Feather import Feather
+from FeatherSwarm import FeatherSwarm
+from Fluid import Fluid
+from LevelGrid import LevelGrid, GOAL, SWARM
+from LevelLoader import LevelLoader
+from Profiler import profiler
+
+WINCON_TIMINGS = [45, 90, 135, 180]
+SWARM_PER_TILE = 24     # swarm feathers started on every swarm tile
+
+LEVELS_DIR = Path(__file__).parent / 'levels'
+
+# what the player does in one step, cloudPos is in world pixels
+Inputs = namedtuple('Inputs', ['cloudPos', 'blowing'])
+
+# a level loaded ahead of time, extras is what onPrepareLevel returned
+PreparedLevel = namedtuple('PreparedLevel', ['level', 'fluid', 'extras'])
+
+
+class Simulation:
+    # the game without a window: level, wind, feather, cloud and the win
+    # condition. sprites and the camera are only needed for rendering
+
+    def __init__(self, levelsDir=LEVELS_DIR, level_i=1, numThreads=0, smokeEnabled=False,
+                 featherSprites=None, cloudSprites=None, _cam=None, preload=True):
+        self.levelsDir = Path(levelsDir)
+        self.level_amount = sum(1 for _ in self.levelsDir.glob('*.lvl'))
+
+        self.numThreads = numThreads
+        self.smokeEnabled = smokeEnabled
+        self.featherSprites = featherSprites if featherSprites is not None else []
+        self.cloudSprites = cloudSprites if cloudSprites is not None else []
+        self.cam = _cam if _cam is not None else cam.Cam()
+
+        # called on the loader thread with a new level and its fluid, returns
+        # what the front-end wants ready for it, e.g. the baked tiles
+        self.onPrepareLevel = None
+        # called with those extras (None if the level wasn't prepared ahead)
+        # after a level was loaded, e.g. to rebuild what's drawn
+        self.onLevelLoaded = None
+
+        # the next and previous levels get prepared in the background, so
+        # winning or F1/F2 only has to swap them in
+        self.loader = LevelLoader(self.prepareLevel) if preload else None
+
+        self.frame_cnt = 0
+        self.level_i = level_i
+        self.level = None
+        self.lev_w = 0
+        self.lev_h = 0
+
+        self.fluid = None
+        self.feather = None
+        self.swarm = None   # the level's other feathers, if it has swarm tiles
+        self.cloud = None
+        self.windSources = []
+        self.blowerPos = None
+
+        self.wincon_cnt = 0
+        self.wincon_state = -1  # -1 not won yet, 0-3 used to displayed the haha + win screen
+
+        self.loadLevel(level_i)
+
+    def prepareLevel(self, level_name):
+        # builds a level without touching the running one, may run on the
+        # loader thread
+        level = LevelGrid.load(self.levelsDir / f"{level_name}.lvl")
+
+        fluid = Fluid(level.lev_w, level.lev_h, 1, numThreads=self.numThreads, smokeEnabled=self.smokeEnabled)
+        fluid.setSpaceMask(~level.solid.T)
+        fluid.setEmitters(level.sources)
+
+        extras = self.onPrepareLevel(level, fluid) if self.onPrepareLevel is not None else None
+
+        return PreparedLevel(level, fluid, extras)
+
+    def loadLevel(self, level_name):
+        print('loading level: ' + str(level_name))
+
+        if self.loader is not None:
+            prepared = self.loader.get(level_name)
+        else:
+            prepared = self.prepareLevel(level_name)
+
+        # smoke may have been switched since it was prepared
+        prepared.fluid.smokeEnabled = self.smokeEnabled
+
+        self.level = prepared.level
+        self.fluid = prepared.fluid
+        self.lev_w = self.level.lev_w
+        self.lev_h = self.level.lev_h
+        self.windSources = self.level.sources
+
+        feather_spawn = self.level.spawn
+
+        if feather_spawn is None:
+            print(f"Feather Spawn not defined in level {level_name}")
+        else:
+            self.feather = Feather(self.featherSprites, self.cam, self.level)
+            self.feather.pos = np.array([feather_spawn[0] * cam.TILE_W + cam.TILE_W / 2,
+                                         feather_spawn[1] * cam.TILE_H + cam.TILE_H / 2])
+
+        self.swarm = self.spawnSwarm()
+
+        self.cloud = Cloud(self.cloudSprites, self.cam)
+        self.blowerPos = None
+        self.wincon_cnt = 0
+        self.wincon_state = -1
+
+        if self.onLevelLoaded is not None:
+            self.onLevelLoaded(prepared.extras)
+
+    def spawnSwarm(self):
+        # spread over each swarm tile, they only ever drift with the wind
+        tiles = self.level.find(SWARM)
+        if not len(tiles):
+            return None
+
+        rng = np.random.default_rng()
+        positions = np.repeat((tiles + 0.5) * (cam.TILE_W, cam.TILE_H), SWARM_PER_TILE, axis=0)
+        positions += rng.uniform(-0.25, 0.25, positions.shape) * (cam.TILE_W, cam.TILE_H)
+        return FeatherSwarm(self.featherSprites, self.cam, self.level, positions)
+
+    def saveLevel(self, level_name):
+        print('saving level: ' + str(level_name))
+
+        with (self.levelsDir / f"{level_name}.lvl").open("w") as f:
+            for line in self.level.lines():
+                f.write(line + '\n')
+
+        # a prepared copy would be the old file
+        if self.loader is not None:
+            self.loader.discard(level_name)
+
+    def nextLevel(self, direction=1):
+        # steps through the levels, wrapping around at both ends
+        self.level_i = self.neighbour(direction)
+        self.loadLevel(self.level_i)
+
+    def neighbour(self, direction):
+        return (self.level_i - 1 + direction) % self.level_amount + 1
+
+    def preloadLevels(self):
+        # the next level goes first, it's the one the win sequence ends in
+        if self.loader is not None:
+            self.loader.prefetch(list(dict.fromkeys([self.neighbour(1), self.neighbour(-1)])))
+
+    def close(self):
+        # stops the loader thread
+        if self.loader is not None:
+            self.loader.close()
+            self.loader = None
+
+    def updateWindSources(self):
+        self.windSources = self.level.sources
+        self.fluid.setEmitters(self.windSources)
+
+    def setTile(self, tile, x, y):
+        # returns whether the tile changed, tiles outside the level never do
+        if not (0 <= x < self.lev_w and 0 <= y < self.lev_h):
+            return False
+        if self.level.tile(x, y) == tile:
+            return False
+
+        self.level.setTile(x, y, tile)
+
+        self.fluid.setSpace(x, y, 0 if self.level.solid[y, x] else 1)
+        self.updateWindSources()
+
+        return True
+
+    def step(self, dt, inputs):
+        # cheap once the levels are being prepared. starting here instead of
+        # in loadLevel lets the front-end hook onPrepareLevel up first
+        self.preloadLevels()
+
+        with profiler.section('wind'):
+            self.fluid.simulate(dt)
+
+        if inputs.blowing:
+            self.cloud.startBlowing(self.frame_cnt)
+        elif self.cloud.blowing:
+            self.cloud.stopBlowing(self.frame_cnt)
+
+        self.cloud.setPosition(*inputs.cloudPos)
+
+        with profiler.section('feather'):
+            self.feather.update(dt, self.frame_cnt, self.fluid)
+        if self.swarm is not None:
+            with profiler.section('swarm'):
+                self.swarm.update(dt, self.frame_cnt, self.fluid)
+        with profiler.section('cloud'):
+            self.cloud.update(dt, self.frame_cnt, self.feather)
+
+        self.blowFromCloud()
+        self.checkWinCondition()
+
+        self.frame_cnt += 1
+
+        if self.wincon_state >= 0:
+            self.wincon_cnt += 1
+            if self.wincon_cnt > WINCON_TIMINGS[len(WINCON_TIMINGS)-1]:
+                self.nextLevel()
+
+    def blowFromCloud(self):
+        if self.cloud.isBlowing():
+            cx, cy = self.cloud.pos[0] / cam.TILE_W, self.cloud.pos[1] / cam.TILE_H
+            blowdir = self.cloud.getBlowDirection()
+            bx, by = cx + blowdir[0], cy + blowdir[1]
+            self.fluid.setBlower(bx, by, blowdir)
+
+            self.blowerPos = (bx, by)
+        else:
+            self.fluid.clearBlower()
+            self.blowerPos = None
+
+    def checkWinCondition(self):
+        feather_tile = self.cam.worldToGrid(self.feather.pos[0],self.feather.pos[1])
+        if self.level.has(GOAL, *feather_tile):
+            if self.wincon_state < 0:
+                self.wincon_state += 1
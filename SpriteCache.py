@@ -0,0 +1,67 @@
+from collections import OrderedDict
+
+import pygame
+
+ANGLE_STEP = 2                  # rotations are snapped to multiples of this (degrees)
+MAX_BYTES = 32 * 1024 * 1024    # memory cap for cached sprites
+
+
+class SpriteCache:
+    def __init__(self, angleStep=ANGLE_STEP, maxBytes=MAX_BYTES):
+        self.angleStep = angleStep
+        self.maxBytes = maxBytes
+
+        # least recently used first, {(sprite, angle, flip): surface}
+        self.sprites = OrderedDict()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def quantize(self, angle):
+        return int(round(angle / self.angleStep)) * self.angleStep % 360
+
+    def get(self, sprite, angle=0, flip=False):
+        # returns sprite flipped horizontally if requested, then rotated
+        # by angle, same as transform.flip + transform.rotate would
+        key = (sprite, self.quantize(angle), flip)
+
+        result = self.sprites.get(key)
+        if result is not None:
+            self.sprites.move_to_end(key)
+            self.hits += 1
+            return result
+
+        self.misses += 1
+
+        result = sprite
+        if flip:
+            result = pygame.transform.flip(result, True, False)
+        if key[1]:
+            result = pygame.transform.rotate(result, key[1])
+
+        self.sprites[key] = result
+        self.bytes += self.surfaceBytes(result)
+
+        while self.bytes > self.maxBytes and len(self.sprites) > 1:
+            _, old = self.sprites.popitem(last=False)
+            self.bytes -= self.surfaceBytes(old)
+
+        return result
+
+    def precompute(self, sprites, flips=(False,)):
+        for sprite in sprites:
+            for flip in flips:
+                for angle in range(0, 360, self.angleStep):
+                    self.get(sprite, angle, flip)
+
+    def surfaceBytes(self, surface):
+        return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+    def clear(self):
+        self.sprites.clear()
+        self.bytes = 0
+
+
+# shared by everything that draws rotated sprites
+spriteCache = SpriteCache()
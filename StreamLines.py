@@ -0,0 +1,137 @@
+import time
+
+import numpy as np
+import pygame
+
+from cam import TILE_W, TILE_H, SCR_W, SCR_H
+
+REGION_SIZE = 8         # region width/height in tiles
+NUM_SEGMENTS = 15       # segments per streamline
+SEGMENT_LENGTH = 0.2    # in tiles, see Fluid.traceStreamLines
+MIN_SPEED = 0.02
+EPSILON = 0.005         # velocity change below which a region keeps its lines
+MAX_AGE = 30            # frames after which a region is retraced anyway
+BUDGET_MS = 2.0         # tracing time per frame
+
+
+class StreamLines:
+    def __init__(self, fluid, lev_w, lev_h, cam, color):
+        self.fluid = fluid
+        self.cam = cam
+        self.color = color
+
+        # lines can leave their region by this many tiles
+        self.pad = int(np.ceil(NUM_SEGMENTS * SEGMENT_LENGTH))
+
+        self.regions_w = (lev_w + REGION_SIZE - 1) // REGION_SIZE
+        self.regions_h = (lev_h + REGION_SIZE - 1) // REGION_SIZE
+
+        # one seed per tile centre, except for the last row and column,
+        # {(rx, ry): (N, 2) array in tiles}
+        self.seeds = {}
+        for ry in range(self.regions_h):
+            for rx in range(self.regions_w):
+                x0, y0 = rx * REGION_SIZE, ry * REGION_SIZE
+                x1, y1 = min(x0 + REGION_SIZE, lev_w - 1), min(y0 + REGION_SIZE, lev_h - 1)
+                seeds = np.mgrid[x0:x1, y0:y1].reshape(2, -1).T + 0.5
+                self.seeds[rx, ry] = np.ascontiguousarray(seeds, dtype=np.float64)
+
+        # traced lines per region as (vertices in world pixels, offsets, colors)
+        self.lines = {}
+        self.snapshots = {}     # velocities at the seeds when last traced
+        self.tracedAt = {}
+
+        self.frame = 0
+        self.lastCamPos = None
+        self.surface = pygame.Surface((SCR_W, SCR_H), pygame.SRCALPHA)
+
+    def visibleRegions(self):
+        # regions whose lines can reach into the screen
+        rw, rh = REGION_SIZE * TILE_W, REGION_SIZE * TILE_H
+        px, py = self.pad * TILE_W, self.pad * TILE_H
+
+        rx0 = max(0, int((self.cam.pos_x - px) // rw))
+        ry0 = max(0, int((self.cam.pos_y - py) // rh))
+        rx1 = min(self.regions_w - 1, int((self.cam.pos_x + SCR_W + px - 1) // rw))
+        ry1 = min(self.regions_h - 1, int((self.cam.pos_y + SCR_H + py - 1) // rh))
+
+        for ry in range(ry0, ry1 + 1):
+            for rx in range(rx0, rx1 + 1):
+                if len(self.seeds[rx, ry]):
+                    yield rx, ry
+
+    def staleness(self, region):
+        # how much the wind at the region's seeds changed since it was traced
+        if region not in self.lines:
+            return np.inf
+
+        velocities = self.fluid.sampleVelocities(self.seeds[region])
+        change = np.abs(velocities - self.snapshots[region]).max()
+
+        if change > EPSILON or self.frame - self.tracedAt[region] >= MAX_AGE:
+            return change
+
+        return 0
+
+    def trace(self, region):
+        seeds = self.seeds[region]
+        vertices, offsets = self.fluid.traceStreamLines(seeds, NUM_SEGMENTS, MIN_SPEED)
+
+        # longer lines are brighter
+        lengths = np.diff(offsets)
+        colors = [pygame.Color(*(int(min(255, c + n * 1.25)) for c in self.color), 255) for n in lengths.tolist()]
+
+        world = np.empty((len(vertices), 2))
+        world[:, 0] = vertices[:, 0] * TILE_W
+        world[:, 1] = vertices[:, 1] * TILE_H
+
+        self.lines[region] = (world, offsets, colors)
+        self.snapshots[region] = self.fluid.sampleVelocities(seeds)
+        self.tracedAt[region] = self.frame
+
+    def update(self):
+        # retraces the visible regions whose wind changed, the most changed
+        # first, until the frame's budget is used up. the rest wait for the
+        # next frames
+        self.frame += 1
+        regions = list(self.visibleRegions())
+
+        stale = []
+        for region in regions:
+            change = self.staleness(region)
+            if change > 0:
+                stale.append((change, region))
+        stale.sort(reverse=True)
+
+        deadline = time.perf_counter() + BUDGET_MS / 1000
+        for i, (change, region) in enumerate(stale):
+            if i > 0 and time.perf_counter() > deadline:
+                break
+            self.trace(region)
+
+        camPos = (self.cam.pos_x, self.cam.pos_y)
+        if stale or camPos != self.lastCamPos:
+            self.lastCamPos = camPos
+            self.draw(regions)
+
+    def draw(self, regions):
+        self.surface.fill((0, 0, 0, 0))
+
+        for region in regions:
+            if region not in self.lines:
+                continue
+
+            world, offsets, colors = self.lines[region]
+
+            screen = np.empty((len(world), 2), dtype=int)
+            screen[:, 0] = world[:, 0] - self.cam.pos_x
+            screen[:, 1] = world[:, 1] - self.cam.pos_y
+            screen = screen.tolist()
+
+            for start, end, color in zip(offsets[:-1].tolist(), offsets[1:].tolist(), colors):
+                if end - start > 1:
+                    pygame.draw.lines(self.surface, color, False, screen[start:end])
+
+    def render(self, screen):
+        self.update()
+        return screen.blit(self.surface, (0, 0))
@@ -0,0 +1,180 @@
+from collections import OrderedDict
+
+import pygame
+
+from LevelGrid import ANIMATED
+from cam import TILE_W, TILE_H, SCR_W, SCR_H
+
+CHUNK_SIZE = 8      # chunk width/height in tiles
+ANIM_SPEED = 12     # frames per animation step of animated tiles
+CHUNK_BYTES = CHUNK_SIZE * TILE_W * CHUNK_SIZE * TILE_H * 4
+MAX_BYTES = 16 * 1024 * 1024    # memory cap for baked chunks, far more than one screen needs
+
+
+class TileLayer:
+    def __init__(self, tiles, level, cam, maxBytes=MAX_BYTES):
+        # tiles maps characters to images, level is a LevelGrid
+        self.level = level
+        self.cam = cam
+
+        # images by tile ID
+        self.tiles = [tiles.get(chr(i)) for i in range(256)]
+
+        self.lev_w = level.lev_w
+        self.lev_h = level.lev_h
+
+        self.chunks_w = (self.lev_w + CHUNK_SIZE - 1) // CHUNK_SIZE
+        self.chunks_h = (self.lev_h + CHUNK_SIZE - 1) // CHUNK_SIZE
+
+        # baked chunks, least recently drawn first. chunks are only baked
+        # once they come into view and dropped again when over the cap
+        self.chunks = OrderedDict()
+        self.chunkFrames = {}   # animation step each chunk was last drawn with
+        self.dirty = set()
+        self.maxBytes = maxBytes
+        self.frame = 0
+
+        # animated cells per chunk, {(cx, cy): {(x, y): tile}}
+        self.animated = {}
+
+        for x, y in level.find(ANIMATED).tolist():
+            self.indexTile(x, y)
+
+    def indexTile(self, x, y):
+        tile = self.level.ids[y, x]
+        cells = self.animated.setdefault((x // CHUNK_SIZE, y // CHUNK_SIZE), {})
+
+        if ANIMATED[tile] and type(self.tiles[tile]) is tuple:
+            cells[x, y] = tile
+        else:
+            cells.pop((x, y), None)
+
+    def drawCell(self, chunk, cx, cy, x, y, tile, frame):
+        t = self.tiles[tile]
+        if type(t) is tuple:
+            t = t[frame % len(t)]
+
+        # tiles don't overlap, so max blending onto the cleared cell copies
+        # them exactly into the transparent chunk, alpha included
+        pos = ((x - cx * CHUNK_SIZE) * TILE_W, (y - cy * CHUNK_SIZE) * TILE_H)
+        chunk.blit(t, pos, special_flags=pygame.BLEND_RGBA_MAX)
+
+    def bakeChunk(self, cx, cy, frame):
+        chunk = self.chunks.get((cx, cy))
+        if chunk is None:
+            chunk = self.newChunk()
+            self.chunks[cx, cy] = chunk
+        chunk.fill((0, 0, 0, 0))
+
+        x0, y0 = cx * CHUNK_SIZE, cy * CHUNK_SIZE
+        rows = self.level.ids[y0:y0 + CHUNK_SIZE, x0:x0 + CHUNK_SIZE].tolist()
+
+        for y, row in enumerate(rows, y0):
+            for x, tile in enumerate(row, x0):
+                if self.tiles[tile] is not None:
+                    self.drawCell(chunk, cx, cy, x, y, tile, frame)
+
+        self.chunkFrames[cx, cy] = frame
+
+    def newChunk(self):
+        # the least recently drawn chunk's surface once over the cap
+        if (len(self.chunks) + 1) * CHUNK_BYTES > self.maxBytes and self.chunks:
+            old, chunk = self.chunks.popitem(last=False)
+            del self.chunkFrames[old]
+            return chunk
+
+        return pygame.Surface((CHUNK_SIZE * TILE_W, CHUNK_SIZE * TILE_H), pygame.SRCALPHA)
+
+    def animateChunk(self, cx, cy, frame):
+        # redraw only the animated cells whose image changed, returns them
+        chunk = self.chunks[cx, cy]
+        last = self.chunkFrames[cx, cy]
+        changed = []
+
+        for (x, y), tile in self.animated.get((cx, cy), {}).items():
+            t = self.tiles[tile]
+            if t[frame % len(t)] is t[last % len(t)]:
+                continue
+
+            chunk.fill((0, 0, 0, 0), ((x - cx * CHUNK_SIZE) * TILE_W, (y - cy * CHUNK_SIZE) * TILE_H, TILE_W, TILE_H))
+            self.drawCell(chunk, cx, cy, x, y, tile, frame)
+            changed.append((x, y))
+
+        self.chunkFrames[cx, cy] = frame
+
+        return changed
+
+    def invalidate(self, x, y):
+        # chunks that aren't baked yet will see the change when they are
+        self.indexTile(x, y)
+        if (x // CHUNK_SIZE, y // CHUNK_SIZE) in self.chunks:
+            self.dirty.add((x // CHUNK_SIZE, y // CHUNK_SIZE))
+
+    def bakeAround(self, x, y):
+        # bakes the chunks a screen centred on world pixel x, y shows
+        cw, ch = CHUNK_SIZE * TILE_W, CHUNK_SIZE * TILE_H
+        cx0 = max(0, int((x - SCR_W / 2) // cw))
+        cy0 = max(0, int((y - SCR_H / 2) // ch))
+        cx1 = min(self.chunks_w - 1, int((x + SCR_W / 2) // cw))
+        cy1 = min(self.chunks_h - 1, int((y + SCR_H / 2) // ch))
+
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                if (cx, cy) not in self.chunks:
+                    self.bakeChunk(cx, cy, self.frame)
+
+    def visibleChunks(self):
+        cx0 = max(0, int(self.cam.pos_x // (CHUNK_SIZE * TILE_W)))
+        cy0 = max(0, int(self.cam.pos_y // (CHUNK_SIZE * TILE_H)))
+        cx1 = min(self.chunks_w - 1, int((self.cam.pos_x + SCR_W - 1) // (CHUNK_SIZE * TILE_W)))
+        cy1 = min(self.chunks_h - 1, int((self.cam.pos_y + SCR_H - 1) // (CHUNK_SIZE * TILE_H)))
+
+        for cy in range(cy0, cy1 + 1):
+            for cx in range(cx0, cx1 + 1):
+                yield cx, cy
+
+    def update(self, frame_cnt):
+        # brings the visible chunks up to date, returns the screen rects
+        # that changed since the last update
+        frame = frame_cnt // ANIM_SPEED
+        self.frame = frame
+        changed = []
+
+        for cx, cy in self.dirty:
+            if (cx, cy) in self.chunks:
+                self.bakeChunk(cx, cy, frame)
+                changed.append(self.chunkRect(cx, cy))
+        self.dirty.clear()
+
+        for cx, cy in self.visibleChunks():
+            if (cx, cy) not in self.chunks:
+                self.bakeChunk(cx, cy, frame)
+                changed.append(self.chunkRect(cx, cy))
+                continue
+
+            self.chunks.move_to_end((cx, cy))
+
+            # chunks out of view catch up once they scroll back in
+            if self.chunkFrames[cx, cy] != frame:
+                for x, y in self.animateChunk(cx, cy, frame):
+                    changed.append(pygame.Rect(self.cam.gridToScreen(x, y), (TILE_W, TILE_H)))
+
+        return changed
+
+    def chunkRect(self, cx, cy):
+        x, y = self.cam.gridToScreen(cx * CHUNK_SIZE, cy * CHUNK_SIZE)
+        return pygame.Rect(x, y, CHUNK_SIZE * TILE_W, CHUNK_SIZE * TILE_H)
+
+    def blit(self, screen):
+        for cx, cy in self.visibleChunks():
+            chunk = self.chunks.get((cx, cy))
+            if chunk is None:
+                self.bakeChunk(cx, cy, self.frame)
+                chunk = self.chunks[cx, cy]
+
+            screen.blit(chunk, self.cam.gridToScreen(cx * CHUNK_SIZE, cy * CHUNK_SIZE))
+
+    def render(self, screen, frame_cnt):
+        changed = self.update(frame_cnt)
+        self.blit(screen)
+        return changed
@@ -9,11 +9,14 @@ import pygame
 import os
 
 import cam
-from Feather import Feather
-from Cloud import Cloud
+from Simulation import Simulation, Inputs, WINCON_TIMINGS, LEVELS_DIR
+from Assets import Assets
+from TileLayer import TileLayer
+from StreamLines import StreamLines
+from SpriteCache import spriteCache
+from Profiler import profiler
 from bitmapfont import BitmapFont
 import time
-from Fluid import Fluid
 import math
 from pathlib import Path
 
@@ -23,21 +26,19 @@ try:
     from settings import *
 except ImportError:
     FULLSCREEN = False
+    FLUID_THREADS = 0
+    DIRTY_RECTS = False
 
 
 TILES = {}
 FEATHERS = []
 CLOUDS = []
 HAHAHA = []
-WINCON_TIMINGS = [45, 90, 135, 180]
-
-WIND_BLOCKERS = ['#', 'd', 'b', 'q', 'p', 'l', '-', '+', 'o', 'u', 'n']
-
 
 SHOW_DEBUG_INFO = __debug__
 SHOW_STREAMLINES = True
+SHOW_SMOKE = False
 
-LEVELS_DIR = Path(__file__).parent / 'levels'
 GFX_DIR = Path(__file__).parent / 'gfx'
 
 class Application:
@@ -46,13 +47,6 @@ class Application:
 
         self.cam = cam.Cam()
         self.running = False
-        self.frame_cnt = 0
-
-        self.level_i = 1
-        self.level = []
-        self.lev_w = 0
-        self.lev_h = 0
-        self.level_amount = sum(1 for _ in LEVELS_DIR.iterdir())
 
         flags = pygame.SCALED
 
@@ -62,21 +56,30 @@ class Application:
         self.screen = pygame.display.set_mode((SCR_W, SCR_H), flags=flags,vsync=1)
         pygame.mouse.set_visible(False)
 
-        self.feather = None
-        self.cloud = None
-        self.windSources = []
+        profiler.enabled = SHOW_DEBUG_INFO
 
+        self.backgroundColor = (64, 96, 128)
+
+        self.assets = Assets(GFX_DIR)
         self.loadGraphics()
-        self.loadLevel(self.level_i)
+
+        self.sim = Simulation(LEVELS_DIR, 1, numThreads=FLUID_THREADS, smokeEnabled=SHOW_SMOKE,
+                              featherSprites=FEATHERS, cloudSprites=CLOUDS, _cam=self.cam)
+        self.sim.onPrepareLevel = self.prepareLevel
+        self.sim.onLevelLoaded = self.levelLoaded
+        self.levelLoaded()
 
         self.mouse_pos = (0, 0)
+        self.blowing = False
 
         self.scroll_xdir = 0
         self.scroll_ydir = 0
 
-        self.backgroundColor = (64, 96, 128)
-
-        self.streamLines = pygame.Surface((SCR_W, SCR_H), pygame.SRCALPHA)
+        # dirty rect presentation, see render()
+        self.background = None
+        self.lastCamPos = None
+        self.lastRects = []
+        self.dirtyRects = []
 
         self.edit_mode = False
         self.edit_tile = '#'
@@ -84,199 +87,129 @@ class Application:
         self.edit_draw = False
         self.edit_delete = False
 
-        self.helpScreen = pygame.Surface((SCR_W / 3, 12 * self.font.line_h), pygame.SRCALPHA)
-        self.wincon_cnt = 0
-        self.wincon_state = -1  # -1 not won yet, 0-3 used to displayed the haha + win screen
-        self.debugTilePos = None
+        self.helpScreen = pygame.Surface((SCR_W / 3, 13 * self.font.line_h), pygame.SRCALPHA)
+        self.helpScreenKey = None
+
+    @property
+    def frame_cnt(self):
+        return self.sim.frame_cnt
 
     def loadGraphics(self):
-        TILES['#'] = pygame.image.load(GFX_DIR / 'tile_wall.png')
-        TILES[' '] = pygame.image.load(GFX_DIR / 'tile_air.png')
-        TILES['*'] = pygame.image.load(GFX_DIR / 'tile_air.png') # feather spawn point, render as empty tile
-        TILES['/'] = pygame.image.load(GFX_DIR / 'tile_air__rain.png')
-        TILES['F'] = (pygame.image.load(GFX_DIR / 'tile_feet.png'), pygame.image.load(GFX_DIR / 'tile_feet2.png'))
-        TILES['a'] = pygame.image.load(GFX_DIR / 'tile_lantern.png')
-        TILES['A'] = pygame.image.load(GFX_DIR / 'tile_lanterntop.png')
-        TILES['_'] = pygame.image.load(GFX_DIR / 'tile_floor.png')
-        TILES['g'] = pygame.image.load(GFX_DIR / 'tile_grill.png')
-        TILES['T'] = pygame.image.load(GFX_DIR / 'tile_housetop_antenna.png')
-        TILES['c'] = pygame.image.load(GFX_DIR / 'tile_air__AC_l.png')
-        TILES['C'] = pygame.image.load(GFX_DIR / 'tile_air__AC_r.png')
-        TILES['h'] = pygame.image.load(GFX_DIR / 'tile_house_l.png')
-        TILES['i'] = pygame.image.load(GFX_DIR / 'tile_house_m.png')
-        TILES['j'] = pygame.image.load(GFX_DIR / 'tile_house_r.png')
-        TILES['H'] = pygame.image.load(GFX_DIR / 'tile_housetop_l.png')
-        TILES['d'] = pygame.image.load(GFX_DIR / 'tile_pipe_d.png')
-        TILES['b'] = pygame.image.load(GFX_DIR / 'tile_pipe_b.png')
-        TILES['q'] = pygame.image.load(GFX_DIR / 'tile_pipe_q.png')
-        TILES['p'] = pygame.image.load(GFX_DIR / 'tile_pipe_p.png')
-        TILES['l'] = pygame.image.load(GFX_DIR / 'tile_pipe_l.png')
-        TILES['-'] = pygame.image.load(GFX_DIR / 'tile_pipe_-.png')
-        TILES['+'] = (pygame.image.load(GFX_DIR / 'tile_pipe_+_1.png'), pygame.image.load(GFX_DIR / 'tile_pipe_+_1.png'), pygame.image.load(GFX_DIR / 'tile_pipe_+_2.png'), pygame.image.load(GFX_DIR / 'tile_pipe_+_2.png'), pygame.image.load(GFX_DIR / 'tile_pipe_+_3.png'), pygame.image.load(GFX_DIR / 'tile_pipe_+_4.png'), pygame.image.load(GFX_DIR / 'tile_pipe_+.png'))
-        TILES['o'] = pygame.image.load(GFX_DIR / 'tile_pipe__motor.png')
-        TILES['u'] = pygame.image.load(GFX_DIR / 'tile_pipe__up_in.png')
-        TILES['n'] = pygame.image.load(GFX_DIR / 'tile_pipe__down_out.png')
-        TILES['E'] = pygame.image.load(GFX_DIR / 'tile_crane.png')
-        TILES['e'] = pygame.image.load(GFX_DIR / 'tile_crane_rope.png')
-        TILES['3'] = pygame.image.load(GFX_DIR / 'tile_crane_rope2.png')
-        TILES['m'] = pygame.image.load(GFX_DIR / 'tile_assembly_line.png')
-        TILES['w'] = pygame.image.load(GFX_DIR / 'tile_workshelf.png')
-        TILES['X'] = (pygame.image.load(GFX_DIR / 'tile_grill1.png'), pygame.image.load(GFX_DIR / 'tile_grill2.png'), pygame.image.load(GFX_DIR / 'tile_grill3.png'))
-        TILES['Y'] = pygame.image.load(GFX_DIR / 'tile_plant.png')
-        # TILES['I'] = pygame.image.load(GFX_DIR / 'tile_housetop_m.png')
-        # TILES['J'] = pygame.image.load(GFX_DIR / 'tile_housetop_r.png')
+        TILES.update(self.assets.atlas('tiles', {
+            '#': 'tile_wall.png',
+            ' ': 'tile_air.png',
+            '*': 'tile_air.png', # feather spawn point, render as empty tile
+            '~': 'tile_air.png', # swarm feathers start here, render as empty tile
+            '/': 'tile_air__rain.png',
+            'F': ('tile_feet.png', 'tile_feet2.png'),
+            'a': 'tile_lantern.png',
+            'A': 'tile_lanterntop.png',
+            '_': 'tile_floor.png',
+            'g': 'tile_grill.png',
+            'T': 'tile_housetop_antenna.png',
+            'c': 'tile_air__AC_l.png',
+            'C': 'tile_air__AC_r.png',
+            'h': 'tile_house_l.png',
+            'i': 'tile_house_m.png',
+            'j': 'tile_house_r.png',
+            'H': 'tile_housetop_l.png',
+            'd': 'tile_pipe_d.png',
+            'b': 'tile_pipe_b.png',
+            'q': 'tile_pipe_q.png',
+            'p': 'tile_pipe_p.png',
+            'l': 'tile_pipe_l.png',
+            '-': 'tile_pipe_-.png',
+            '+': ('tile_pipe_+_1.png', 'tile_pipe_+_1.png', 'tile_pipe_+_2.png', 'tile_pipe_+_2.png', 'tile_pipe_+_3.png', 'tile_pipe_+_4.png', 'tile_pipe_+.png'),
+            'o': 'tile_pipe__motor.png',
+            'u': 'tile_pipe__up_in.png',
+            'n': 'tile_pipe__down_out.png',
+            'E': 'tile_crane.png',
+            'e': 'tile_crane_rope.png',
+            '3': 'tile_crane_rope2.png',
+            'm': 'tile_assembly_line.png',
+            'w': 'tile_workshelf.png',
+            'X': ('tile_grill1.png', 'tile_grill2.png', 'tile_grill3.png'),
+            'Y': 'tile_plant.png',
+            # 'I': 'tile_housetop_m.png',
+            # 'J': 'tile_housetop_r.png',
+        }))
 
         global FEATHERS
-        FEATHERS += [pygame.image.load(GFX_DIR / 'feather1.png'),
-                     pygame.image.load(GFX_DIR / 'feather2.png'),
-                     pygame.image.load(GFX_DIR / 'feather3.png'),
-                     pygame.image.load(GFX_DIR / 'feather4.png'),
-                     pygame.image.load(GFX_DIR / 'feather5.png'),
-                     pygame.image.load(GFX_DIR / 'feather6.png'),
-                     pygame.image.load(GFX_DIR / 'feather7.png'),
-                     pygame.image.load(GFX_DIR / 'feather8.png'),
-                     ]
+        FEATHERS += self.assets.atlas('feathers', ['feather%i.png' % i for i in range(1, 9)])
 
         global CLOUDS
-        CLOUDS += [pygame.image.load(GFX_DIR / 'cloud1.png'),
-                   pygame.image.load(GFX_DIR / 'cloud2.png'),
-                   pygame.image.load(GFX_DIR / 'cloud3.png'),
-                   pygame.image.load(GFX_DIR / 'cloud4.png'),
-                   pygame.image.load(GFX_DIR / 'cloud5.png'),
-                   pygame.image.load(GFX_DIR / 'cloud6.png'),
-                   pygame.image.load(GFX_DIR / 'cloud7.png'),
-                   ]
+        CLOUDS += self.assets.atlas('clouds', ['cloud%i.png' % i for i in range(1, 8)])
+
+        # the feather spins through every angle, so rotate it up front. the
+        # cloud only faces the feather and gets cached as it goes
+        spriteCache.precompute(FEATHERS)
 
         global HAHAHA
-        HAHAHA += [
-            pygame.image.load(GFX_DIR / 'laughing_1.png'),
-            pygame.image.load(GFX_DIR / 'laughing_2.png'),
-            pygame.image.load(GFX_DIR / 'laughing_3.png'),
-        ]
+        HAHAHA += self.assets.atlas('laughing', ['laughing_1.png', 'laughing_2.png', 'laughing_3.png'])
 
         self.font = BitmapFont(GFX_DIR / 'heimatfont.png', font_w=8, font_h=8, line_h=10, scr_w=SCR_W, scr_h=SCR_H)
         self.bigfont = BitmapFont(GFX_DIR / 'heimatfont.png', font_w=8, font_h=8, line_h=10, zoom=3, scr_w=SCR_W, scr_h=SCR_H)
 
-    def loadLevel(self, level_name):
-        print('loading level: ' + str(level_name))
+    def exportProfile(self, kind):
+        # saves the recorded frames next to where the game was started
+        path = time.strftime('profile-%Y%m%d-%H%M%S.') + kind
+        if kind == 'csv':
+            saved = profiler.exportCsv(path)
+        else:
+            saved = profiler.exportChromeTrace(path)
 
-        with (LEVELS_DIR / f"{level_name}.lvl").open() as f:
-            self.level = [line.rstrip("\r\n") for line in f.readlines()]
+        if saved:
+            print('saved profile: ' + path)
+        else:
+            print('no profile saved, nothing recorded (F12 turns the profiler on)')
 
-        # find longest line
-        lev_w = 0
-        for line in self.level:
-            lev_w = max(lev_w, len(line))
+    def prepareLevel(self, level, fluid):
+        # runs on the simulation's loader thread. only the chunks seen first
+        # are baked, the camera starts top left and scrolls to the spawn
+        tileLayer = TileLayer(TILES, level, self.cam)
+        tileLayer.bakeAround(SCR_W / 2, SCR_H / 2)
+        if level.spawn is not None:
+            tileLayer.bakeAround((level.spawn[0] + .5) * TILE_W, (level.spawn[1] + .5) * TILE_H)
 
-        # pad shorter lines with spaces
-        for i, line in enumerate(self.level):
-            if len(line) < lev_w:
-                self.level[i] += ' ' * (lev_w - len(line))
+        return tileLayer, StreamLines(fluid, level.lev_w, level.lev_h, self.cam, self.backgroundColor)
 
-        self.lev_w = lev_w
-        self.lev_h = len(self.level)
+    def levelLoaded(self, prepared=None):
+        sim = self.sim
         self.cam.reset()
 
-        self.fluid = Fluid(self.lev_w, self.lev_h, 1)
-        self.smoke = pygame.Surface((TILE_W * self.lev_w, TILE_H * self.lev_h), pygame.SRCALPHA)
-        self.updateLevelWind()
-
-        self.updateWindSources()
+        self.smoke = pygame.Surface((sim.lev_w, sim.lev_h), pygame.SRCALPHA)
+        self.smoke.fill((255, 255, 255, 0))
+        self.smokeScaled = None
 
-        feather_spawn = None
-        for y in range(self.lev_h):
-            for x in range(self.lev_w):
-                if self.level[y][x] == "*":  # look for feather spawn
-                    feather_spawn = (x, y)
-
-        if feather_spawn is None:
-            print(f"Feather Spawn not defined in level {level_name}")
-        else:
-            self.feather = Feather(FEATHERS, self.cam, self.level)
-            gridCenterOffset = np.array([TILE_W/2, TILE_H/2])
-            self.feather.pos = self.cam.gridToScreen(*feather_spawn) + gridCenterOffset
-
-        self.cloud = Cloud(CLOUDS, self.cam)
-        self.wincon_cnt = 0
-        self.wincon_state = -1
-
-    def updateWindSources(self):
-        self.windSources.clear()
-
-        for y in range(self.lev_h):
-            for x in range(self.lev_w):
-                if self.level[y][x] == "X": # heat grill
-                    self.windSources.append((x, y-1, 0, -1))
-                if self.level[y][x] == "+": # pipe grill
-                    self.windSources.append((x, y-1, 0, -1))
-                    self.windSources.append((x, y+1, 0, +1))
-
-    def updateLevelWind(self):
-        for y in range(self.lev_h):
-            for x in range(self.lev_w):
-                if self.level[y][x] in WIND_BLOCKERS:
-                    self.fluid.setSpace(x, y, 0)
-                    self.fluid.setBlockVelocity(x, y, (0.0, 0.0))
-                else:
-                    self.fluid.setSpace(x, y, 1)
-
-    def saveLevel(self, level_name):
-        print('saving level: ' + str(level_name))
-
-        with (LEVELS_DIR / f"{level_name}.lvl").open("w") as f:
-            for line in self.level:
-                f.write(line + '\n')
-
-        self.edit_mode = False
+        if prepared is None:
+            prepared = self.prepareLevel(sim.level, sim.fluid)
+        self.tileLayer, self.streamLines = prepared
+        self.background = None
 
     def showSmoke(self):
-        smoke = np.repeat(np.repeat(
-            (self.fluid.smoke * 255).astype(np.uint8)[1:-1, 1:-1],
-            TILE_W, axis=0), TILE_H, axis=1
-        )
-
-        surface_alpha = np.array(self.smoke.get_view('A'), copy=False)
-        surface_alpha[:,:] = smoke
-        surface_alpha = None
-
-        self.screen.blit(self.smoke, (0, 0))
-
-    def updateStreamLines(self):
-        #if self.frame_cnt % 5 != 0:
-        #    return
-
-        numSegs = 15
-
-        minSpeed = 0.1
-
-        self.streamLines.fill((0,0,0,0))
-
-        for i in range(0, self.lev_w - 1):
-            for j in range(0, self.lev_h - 1):
-                x = i + 0.5
-                y = j + 0.5
-
-                points = []
-                for (x_, y_, v) in self.fluid.getStreamLine(x, y, 15, 0.02):
-                    if x_ >= self.lev_w or y_ >= self.lev_h:
-                        continue
+        # one pixel per tile, only the visible tiles get scaled up
+        alpha = pygame.surfarray.pixels_alpha(self.smoke)
+        np.multiply(self.sim.fluid.smokeTiles, 255, out=alpha, casting='unsafe')
+        del alpha
 
-                    # todo filter points in wall
-                    points.append((x_, y_, v))
+        x0 = max(0, int(self.cam.pos_x // TILE_W))
+        y0 = max(0, int(self.cam.pos_y // TILE_H))
+        x1 = min(self.sim.lev_w, int(math.ceil((self.cam.pos_x + SCR_W) / TILE_W)))
+        y1 = min(self.sim.lev_h, int(math.ceil((self.cam.pos_y + SCR_H) / TILE_H)))
+        if x1 <= x0 or y1 <= y0:
+            return
 
-                if len(points) > 1:
-                    points = [(self.cam.gridToScreen(x_, y_), v) for (x_, y_, v) in points]
-                    points = [p[0] for p in points]
+        size = ((x1 - x0) * TILE_W, (y1 - y0) * TILE_H)
+        if self.smokeScaled is None or self.smokeScaled.get_size() != size:
+            self.smokeScaled = pygame.Surface(size, pygame.SRCALPHA)
 
-                    r = int(min(255, self.backgroundColor[0] + len(points) * 1.25))
-                    g = int(min(255, self.backgroundColor[1] + len(points) * 1.25))
-                    b = int(min(255, self.backgroundColor[2] + len(points) * 1.25))
+        visible = self.smoke.subsurface((x0, y0, x1 - x0, y1 - y0))
+        pygame.transform.smoothscale(visible, size, self.smokeScaled)
 
-                    pygame.draw.lines(self.streamLines, pygame.Color(r, g, b, 255), False, points)
+        self.screen.blit(self.smokeScaled, self.cam.gridToScreen(x0, y0))
 
     def showStreamLines(self):
-        self.updateStreamLines()
-        self.screen.blit(self.streamLines, (0, 0))
+        self.streamLines.render(self.screen)
 
     def drawTile(self, tile, x, y):
         t = TILES[tile]
@@ -288,16 +221,15 @@ class Application:
         self.screen.blit(t, self.cam.gridToScreen(x, y))
 
     def setTile(self, tile, x, y):
-        line = self.level[y]
-        line = line[:x] + tile + line[x+1:]
-        self.level[y] = line
+        if self.sim.setTile(tile, x, y):
+            self.tileLayer.invalidate(x, y)
 
     def updateCamera(self):
         if not self.edit_mode:
-            x, y = self.feather.pos
+            x, y = self.sim.feather.pos
             self.cam.followPos(x, y)
 
-        bounds = (self.lev_w, self.lev_h)
+        bounds = (self.sim.lev_w, self.sim.lev_h)
         self.cam.scroll(bounds, (self.scroll_xdir, self.scroll_ydir))
 
     def updateEdit(self):
@@ -306,64 +238,129 @@ class Application:
             mx, my = self.cam.screenToGrid(*self.mouse_pos)
             self.setTile(self.edit_tile, mx, my)
 
-            self.updateWindSources()
-            self.updateLevelWind()
-
         if self.edit_delete:
             # delete / set empty tile in grid
             mx, my = self.cam.screenToGrid(*self.mouse_pos)
             self.setTile(' ', mx, my)
 
-            self.updateWindSources()
-            self.updateLevelWind()
+    def updateHelpScreen(self):
+        # the panel only changes with the level and the mode, so it's
+        # composed once and reused until one of them changes
+        key = (self.sim.level_i, self.sim.lev_w, self.sim.lev_h, self.edit_mode)
+        if key == self.helpScreenKey:
+            return
+        self.helpScreenKey = key
+
+        self.helpScreen.fill((00, 0, 0, 64))
+
+        self.font.drawText(self.helpScreen, 'LEVEL %02i (%02ix%02i)' % (self.sim.level_i, self.sim.lev_w, self.sim.lev_h), x=1, y=1)
+        self.font.drawText(self.helpScreen, '')
+        # self.font.drawText(self.helpScreen, 'WASD = SCROLL AROUND')
+        self.font.drawText(self.helpScreen, 'F1/F2 = PREV/NEXT LEVEL')
+        self.font.drawText(self.helpScreen, '')
+        self.font.drawText(self.helpScreen, 'F5/F6 = PROFILE CSV/TRACE')
+        self.font.drawText(self.helpScreen, 'F7    = WIND SMOKE')
+        self.font.drawText(self.helpScreen, 'F8    = WIND LINES')
+        self.font.drawText(self.helpScreen, 'F10   = EDIT MODE')
+        self.font.drawText(self.helpScreen, 'F12   = THIS HELP')
+        self.font.drawText(self.helpScreen, '')
 
-    def render(self):
-        self.screen.fill(self.backgroundColor)
+        if self.edit_mode:
+            self.font.drawText(self.helpScreen, '------- EDIT MODE -------')
+            self.font.drawText(self.helpScreen, 'F9  = SAVE (OVERWRITE)')
+
+    def markDirty(self, rect):
+        if rect is not None:
+            self.dirtyRects.append(pygame.Rect(rect))
 
-        # show wind
-        if SHOW_STREAMLINES:
-            #self.fluid.smoke[3, 3] = 1.0
-            self.showStreamLines()
-            #self.showSmoke()
+    def updateBackground(self):
+        # the background is the level without anything moving on it. it's
+        # only redrawn when the tiles changed, returns the changed rects
+        changed = self.tileLayer.update(self.frame_cnt)
 
-        # render level
-        for y in range(self.lev_h):
-            for x in range(self.lev_w):
-                tile = self.level[y][x]
+        if self.background is None:
+            self.background = pygame.Surface((SCR_W, SCR_H))
+            changed = [self.screen.get_rect()]
+        elif not changed:
+            return changed
 
-                if tile in TILES:
-                    self.drawTile(tile, x, y)
+        self.background.fill(self.backgroundColor)
+        self.tileLayer.blit(self.background)
+
+        for rect in changed:
+            self.screen.blit(self.background, rect, rect)
+
+        return changed
+
+    def render(self):
+        # in dirty rect mode only the things that move are redrawn, on top
+        # of a cached background. a moving camera or animated wind changes
+        # the whole screen, so those frames are drawn and flipped in full
+        camPos = (self.cam.pos_x, self.cam.pos_y)
+        fullRedraw = (not DIRTY_RECTS or SHOW_STREAMLINES or SHOW_SMOKE or self.edit_mode
+                      or camPos != self.lastCamPos)
+        self.lastCamPos = camPos
+        self.dirtyRects = []
+
+        if fullRedraw:
+            self.background = None
+            self.screen.fill(self.backgroundColor)
+
+            # show wind
+            if SHOW_STREAMLINES:
+                with profiler.section('wind lines'):
+                    self.showStreamLines()
+
+            if SHOW_SMOKE:
+                with profiler.section('smoke'):
+                    self.showSmoke()
+
+            # render level
+            with profiler.section('tiles'):
+                self.tileLayer.render(self.screen, self.frame_cnt)
+        else:
+            with profiler.section('tiles'):
+                changed = self.updateBackground()
+
+                # restore what was drawn over last frame
+                for rect in self.lastRects:
+                    self.screen.blit(self.background, rect, rect)
 
         # render feather
-        self.feather.render(self.screen)
+        with profiler.section('sprites'):
+            self.markDirty(self.sim.feather.render(self.screen))
+
+            if self.sim.swarm is not None:
+                for rect in self.sim.swarm.render(self.screen):
+                    self.markDirty(rect)
 
         # render cloud (player)
         if not self.edit_mode:
-            self.cloud.render(self.screen)
+            with profiler.section('sprites'):
+                self.markDirty(self.sim.cloud.render(self.screen))
 
         # render win HAHA
-        if self.wincon_state >= 0:
+        if self.sim.wincon_state >= 0:
             for i in range(0, 3):
-                if self.wincon_cnt >= WINCON_TIMINGS[i]:
+                if self.sim.wincon_cnt >= WINCON_TIMINGS[i]:
 
-                    for y in range(self.lev_h):
-                        for x in range(self.lev_w):
-                            if self.level[y][x] == "F":
-                                feet_pos = self.cam.gridToWorld_tileCenter(x,y)
+                    # the last feet tile in reading order
+                    x, y = self.sim.level.goals[-1]
+                    feet_pos = self.cam.gridToWorld_tileCenter(x,y)
                     offset = 50*i + 20
                     haha = HAHAHA[i]
                     scale = ((i + 1) /5 ** 2)
                     if i == 0:
                         scale *= 1.5
                     haha = pygame.transform.smoothscale(haha, (haha.get_width() * scale, haha.get_height() * scale))
-                    self.screen.blit(haha, (feet_pos[0] + offset, feet_pos[1] - offset*0.3))
+                    self.markDirty(self.screen.blit(haha, (feet_pos[0] + offset, feet_pos[1] - offset*0.3)))
 
-            if self.level_i == self.level_amount:
-                self.bigfont.centerText(self.screen, "CONGRATULATIONS", y=7)
-                self.font.centerText(self.screen, "YOU WON THE GAME", y=10)
+            if self.sim.level_i == self.sim.level_amount:
+                self.markDirty(self.bigfont.centerText(self.screen, "CONGRATULATIONS", y=7))
+                self.markDirty(self.font.centerText(self.screen, "YOU WON THE GAME", y=10))
             else:
-                if self.wincon_cnt >= WINCON_TIMINGS[2]:
-                    self.font.centerText(self.screen, "LEVEL COMPLETE", y=15)
+                if self.sim.wincon_cnt >= WINCON_TIMINGS[2]:
+                    self.markDirty(self.font.centerText(self.screen, "LEVEL COMPLETE", y=15))
 
         # show help
         if SHOW_DEBUG_INFO:
@@ -371,41 +368,34 @@ class Application:
             #    self.bigfont.drawText(self.screen, 'DEBUG VIEW', x=1, y=2)
 
             # show help screen
-            self.helpScreen.fill((00, 0, 0, 64))
-
-            self.font.drawText(self.helpScreen, 'LEVEL %02i (%02ix%02i)' % (self.level_i, self.lev_w, self.lev_h), x=1, y=1)
-            self.font.drawText(self.helpScreen, '')
-            # self.font.drawText(self.helpScreen, 'WASD = SCROLL AROUND')
-            self.font.drawText(self.helpScreen, 'F1/F2 = PREV/NEXT LEVEL')
-            self.font.drawText(self.helpScreen, '')
-            self.font.drawText(self.helpScreen, 'F8    = WIND LINES')
-            self.font.drawText(self.helpScreen, 'F10   = EDIT MODE')
-            self.font.drawText(self.helpScreen, 'F12   = THIS HELP')
-            self.font.drawText(self.helpScreen, '')
+            with profiler.section('overlay'):
+                self.updateHelpScreen()
 
-            if self.edit_mode:
-                self.font.drawText(self.helpScreen, '------- EDIT MODE -------')
-                self.font.drawText(self.helpScreen, 'F9  = SAVE (OVERWRITE)')
+                self.markDirty(self.screen.blit(self.helpScreen, (SCR_W * 0.6, 8)))
 
-            self.screen.blit(self.helpScreen, (SCR_W * 0.6, 8))
+                # frame time breakdown below it
+                pos = (SCR_W * 0.6, 8 + self.helpScreen.get_height() + 4)
+                self.markDirty(profiler.renderOverlay(self.screen, self.font, pos, self.helpScreen.get_width()))
 
             # show debug tile
-            if self.debugTilePos:
-                rx, ry = self.cam.gridToScreen(*self.debugTilePos)
-                pygame.draw.rect(self.screen, (255, 255, 0), (rx, ry, TILE_W, TILE_H), width=1)
+            if self.sim.blowerPos:
+                rx, ry = self.cam.gridToScreen(*self.sim.blowerPos)
+                self.markDirty(pygame.draw.rect(self.screen, (255, 255, 0), (rx, ry, TILE_W, TILE_H), width=1))
 
             # show point positions
-            px, py = self.cam.worldToScreen(*self.cloud.pos)
+            px, py = self.cam.worldToScreen(*self.sim.cloud.pos)
             self.screen.set_at((px, py), (255, 0, 255))
+            self.markDirty((px, py, 1, 1))
 
-            px, py = self.cam.worldToScreen(*self.feather.pos)
+            px, py = self.cam.worldToScreen(*self.sim.feather.pos)
             self.screen.set_at((px, py), (255, 128, 0))
+            self.markDirty((px, py, 1, 1))
 
             # show feather bounding box
-            bbox = self.feather.getBoundingBox()
+            bbox = self.sim.feather.getBoundingBox()
             bbx, bby = self.cam.worldToScreen(bbox[0], bbox[1])
             bbw, bbh = bbox[2] - bbox[0] + 1, bbox[3] - bbox[1] + 1
-            pygame.draw.rect(self.screen, (255, 128, 0), (bbx, bby, bbw, bbh), width=1)
+            self.markDirty(pygame.draw.rect(self.screen, (255, 128, 0), (bbx, bby, bbw, bbh), width=1))
 
         # show edit cursor
         if self.edit_mode:
@@ -423,7 +413,13 @@ class Application:
             rx, ry = self.cam.gridToScreen(mx, my)
             pygame.draw.rect(self.screen, color, (rx, ry, TILE_W, TILE_H), width=1)
 
-        pygame.display.flip()
+        with profiler.section('present'):
+            if fullRedraw:
+                pygame.display.flip()
+            else:
+                pygame.display.update(self.lastRects + self.dirtyRects + changed)
+
+        self.lastRects = self.dirtyRects
 
     def controls(self):
         events = pygame.event.get()
@@ -438,23 +434,24 @@ class Application:
                 elif e.key == pygame.K_F11:
                     pygame.display.toggle_fullscreen()
                 elif e.key == pygame.K_F1:
-                    self.level_i -= 1
-                    if self.level_i < 1:
-                        self.level_i = self.level_amount
-                    self.loadLevel(self.level_i)
+                    self.sim.nextLevel(-1)
                 elif e.key == pygame.K_F2:
-                    self.level_i += 1
-                    if self.level_i > self.level_amount:
-                        self.level_i = 1
-                    self.loadLevel(self.level_i)
+                    self.sim.nextLevel(1)
                 elif e.key == pygame.K_F12:
                     global SHOW_DEBUG_INFO
                     SHOW_DEBUG_INFO = not SHOW_DEBUG_INFO
+                    profiler.enabled = SHOW_DEBUG_INFO
+                    profiler.clear()
+                elif e.key == pygame.K_F5:
+                    self.exportProfile('csv')
+                elif e.key == pygame.K_F6:
+                    self.exportProfile('json')
                 elif e.key == pygame.K_F10:
                     self.edit_mode = not self.edit_mode
                 elif e.key == pygame.K_F9:
                     if self.edit_mode:
-                        self.saveLevel(self.level_i)
+                        self.sim.saveLevel(self.sim.level_i)
+                        self.edit_mode = False
 
                         # quick and dirty flash
                         self.screen.fill((255, 255, 255))
@@ -465,6 +462,14 @@ class Application:
                     global SHOW_STREAMLINES
                     SHOW_STREAMLINES = not SHOW_STREAMLINES
 
+                elif e.key == pygame.K_F7:
+                    global SHOW_SMOKE
+                    SHOW_SMOKE = not SHOW_SMOKE
+                    self.sim.smokeEnabled = SHOW_SMOKE
+                    self.sim.fluid.smokeEnabled = SHOW_SMOKE
+                    if not SHOW_SMOKE:
+                        self.sim.fluid.clearSmoke()
+
                 elif e.key == pygame.K_RETURN:
                     if modstate & pygame.KMOD_ALT:
                         pygame.display.toggle_fullscreen()
@@ -485,7 +490,7 @@ class Application:
                             self.edit_draw = False
 
                     else:
-                        self.cloud.stopBlowing(self.frame_cnt)
+                        self.blowing = False
 
                 elif e.button == 3:     # RIGHT mousebutton
                     if self.edit_delete:
@@ -496,7 +501,7 @@ class Application:
                     if self.edit_mode:
                         self.edit_draw = True
                     else:
-                        self.cloud.startBlowing(self.frame_cnt)
+                        self.blowing = True
 
                 elif e.button == 3:     # RIGHT mousebutton
                     self.edit_delete = True
@@ -525,49 +530,14 @@ class Application:
                 self.running = False
 
     def update(self, dt):
-        self.fluid.simulate(dt)
         self.updateCamera()
 
-        self.cloud.setPosition(self.mouse_pos[0] + self.cam.pos_x, self.mouse_pos[1] + self.cam.pos_y)
-
-        self.feather.update(dt, self.frame_cnt, self.fluid)
-        self.cloud.update(dt, self.frame_cnt, self.feather)
-
-        self.blowFromCloud()
-        self.checkWinCondition()
-
-        if self.wincon_state >= 0:
-            self.wincon_cnt += 1
-            if self.wincon_cnt > WINCON_TIMINGS[len(WINCON_TIMINGS)-1]:
-                self.level_i += 1
-                if self.level_i > self.level_amount:
-                    self.level_i = 1
-                self.loadLevel(self.level_i)
-
+        cloudPos = (self.mouse_pos[0] + self.cam.pos_x, self.mouse_pos[1] + self.cam.pos_y)
+        self.sim.step(dt, Inputs(cloudPos, self.blowing))
 
         if self.edit_mode:
             self.updateEdit()
 
-    def blowFromCloud(self):
-        if self.cloud.isBlowing():
-            cx, cy = self.cloud.pos[0] / cam.TILE_W, self.cloud.pos[1] / cam.TILE_H
-            blowdir = self.cloud.getBlowDirection()
-            bx, by = cx + blowdir[0], cy + blowdir[1]
-            self.fluid.setVelocity(bx, by, blowdir)
-
-            self.debugTilePos = (bx, by)
-        else:
-            self.debugTilePos = None
-        for xpos, ypos, xblow, yblow in self.windSources:
-            self.fluid.setVelocity(xpos, ypos, (xblow, yblow))
-
-    def checkWinCondition(self):
-        feather_tile = self.cam.worldToGrid(self.feather.pos[0],self.feather.pos[1])
-        tile_chr = self.level[feather_tile[1]][feather_tile[0]]
-        if tile_chr == "F":
-            if self.wincon_state < 0:
-                self.wincon_state += 1
-
     def run(self):
         self.running = True
 
@@ -577,16 +547,25 @@ class Application:
         while self.running:
             t = time.time()
 
-            self.render()
-            self.controls()
-            self.update(dt)
+            profiler.beginFrame()
+
+            with profiler.section('render'):
+                self.render()
+            with profiler.section('controls'):
+                self.controls()
+            with profiler.section('update'):
+                self.update(dt)
 
-            clock.tick(60)
-            self.frame_cnt += 1
+            with profiler.section('idle'):
+                clock.tick(60)
             dt = time.time() - t
 
+            profiler.endFrame()
+
+        self.sim.close()
         pygame.quit()
 
 
-app = Application()
-app.run()
+if __name__ == '__main__':
+    app = Application()
+    app.run()
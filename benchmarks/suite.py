@@ -0,0 +1,258 @@
+#
+# benchmarks for the wind simulation, the wind lines, the feather physics
+# and rendering a whole frame
+#
+# run from the repository root after building the extension:
+#   python benchmarks/suite.py -o results.json
+#   python benchmarks/suite.py --compare results.json
+#
+# rendering uses SDL's dummy video driver, so no window is needed
+#
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('PYGAME_HIDE_SUPPORT_PROMPT', '1')
+
+ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(ROOT))
+
+import numpy as np
+
+from cam import Cam
+from FeatherSwarm import FeatherSwarm
+from StreamLines import StreamLines
+from Simulation import Simulation, Inputs, LEVELS_DIR
+
+from pressure_solvers import buildFluid
+
+FLUID_SIZES = [(20, 12), (64, 32), (128, 64)]   # in tiles
+FLUID_GRANULARITIES = [1, 2, 4]
+SWARM_SIZES = [100, 1000, 5000]
+LEVELS = sorted(int(path.stem) for path in LEVELS_DIR.glob('*.lvl'))
+DT = 1 / 60
+WARMUP = 10     # frames run before measuring, so the wind is already blowing
+REPEAT = 60     # measured calls per benchmark
+THRESHOLD = 0.10    # slowdown against the baseline that counts as regression
+
+
+def timeCalls(fn, before, repeat):
+    # seconds per call of fn, before is run untimed ahead of every call
+    times = []
+    for i in range(repeat):
+        if before is not None:
+            before()
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def warmedUpSimulation(level_i):
+    sim = Simulation(LEVELS_DIR, level_i)
+    inputs = blowingInputs(sim)
+    for i in range(WARMUP):
+        sim.step(DT, inputs)
+    return sim, inputs
+
+
+def blowingInputs(sim):
+    # the cloud hovering above the feather and blowing at it
+    x, y = sim.feather.pos
+    return Inputs((x - 48, y - 48), True)
+
+
+def benchFluid():
+    for w, h in FLUID_SIZES:
+        for granularity in FLUID_GRANULARITIES:
+            fluid = buildFluid(w, h, granularity, 'sor')
+            for i in range(WARMUP):
+                fluid.simulate(DT)
+
+            yield 'fluid.simulate %ix%i g%i' % (w, h, granularity), lambda: fluid.simulate(DT), None
+
+
+def benchStreamLines():
+    for level_i in LEVELS:
+        sim, inputs = warmedUpSimulation(level_i)
+        step = lambda: sim.step(DT, inputs)
+
+        # every tile of the level at once
+        seeds = np.mgrid[0:sim.lev_w - 1, 0:sim.lev_h - 1].reshape(2, -1).T + 0.5
+        seeds = np.ascontiguousarray(seeds, dtype=np.float64)
+        trace = lambda: sim.fluid.traceStreamLines(seeds, 15, 0.02)
+        yield 'streamlines.trace level %i' % level_i, trace, step
+
+        # the time-sliced layer the game draws, camera on the feather
+        cam = Cam()
+        streamLines = StreamLines(sim.fluid, sim.lev_w, sim.lev_h, cam, (64, 96, 128))
+
+        def follow():
+            step()
+            cam.followPos(*sim.feather.pos)
+            cam.scroll((sim.lev_w, sim.lev_h), (0, 0))
+
+        yield 'streamlines.update level %i' % level_i, streamLines.update, follow
+
+
+def swarmPositions(sim, n):
+    # spread over the level, away from the border
+    rng = np.random.default_rng(0)
+    return rng.uniform((64, 64), (sim.lev_w * 32 - 64, sim.lev_h * 32 - 64), (n, 2))
+
+
+def benchFeather():
+    for level_i in LEVELS:
+        sim, inputs = warmedUpSimulation(level_i)
+
+        def update():
+            sim.feather.update(DT, sim.frame_cnt, sim.fluid)
+
+        yield 'feather.update level %i' % level_i, update, lambda: sim.fluid.simulate(DT)
+        yield 'simulation.step level %i' % level_i, lambda: sim.step(DT, inputs), None
+
+    sim, inputs = warmedUpSimulation(LEVELS[-1])
+    for n in SWARM_SIZES:
+        swarm = FeatherSwarm([], sim.cam, sim.level, swarmPositions(sim, n), seed=0)
+        update = lambda: swarm.update(DT, sim.frame_cnt, sim.fluid)
+        yield 'swarm.update %i feathers' % n, update, lambda: sim.step(DT, inputs)
+
+
+def loadApplication():
+    spec = importlib.util.spec_from_file_location('game', ROOT / '__main__.py')
+    game = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(game)
+    return game.Application()
+
+
+def benchRender():
+    app = loadApplication()
+
+    for level_i in LEVELS:
+        app.sim.level_i = level_i
+        app.sim.loadLevel(level_i)
+        app.blowing = True
+        for i in range(WARMUP):
+            app.render()
+            app.update(DT)
+
+        yield 'application.render level %i' % level_i, app.render, lambda: app.update(DT)
+
+    for n in SWARM_SIZES:
+        swarm = FeatherSwarm(app.sim.featherSprites, app.cam, app.sim.level, swarmPositions(app.sim, n), seed=0)
+
+        def step():
+            app.update(DT)
+            swarm.update(DT, app.sim.frame_cnt, app.sim.fluid)
+
+        yield 'swarm.render %i feathers' % n, lambda: swarm.render(app.screen), step
+
+
+BENCHMARKS = {
+    'fluid': benchFluid,
+    'streamlines': benchStreamLines,
+    'feather': benchFeather,
+    'render': benchRender,
+}
+
+
+def run(groups, repeat, pattern=None):
+    results = {}
+
+    for group in groups:
+        # every benchmark is a name, the call to time and an untimed call
+        # run ahead of each one to move the game on
+        for name, fn, before in BENCHMARKS[group]():
+            if pattern and pattern not in name:
+                continue
+
+            ms = [t * 1000 for t in timeCalls(fn, before, repeat)]
+            results[name] = {
+                'median_ms': statistics.median(ms),
+                'min_ms': min(ms),
+                'mean_ms': statistics.fmean(ms),
+                'stdev_ms': statistics.stdev(ms) if len(ms) > 1 else 0.0,
+                'repeat': len(ms),
+            }
+            print('%-40s %9.3f ms  (min %.3f)' % (name, results[name]['median_ms'], results[name]['min_ms']), flush=True)
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    # returns the names of the benchmarks that got slower than the threshold
+    regressions = []
+
+    print()
+    print('%-40s %10s %10s %8s' % ('benchmark', 'baseline', 'now', 'change'))
+
+    for name, result in results.items():
+        if name not in baseline:
+            print('%-40s %10s %10.3f %8s' % (name, '-', result['median_ms'], 'new'))
+            continue
+
+        before = baseline[name]['median_ms']
+        change = result['median_ms'] / before - 1 if before > 0 else 0.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+
+        print('%-40s %10.3f %10.3f %+7.1f%%%s' % (name, before, result['median_ms'], change * 100, flag))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmarks for Time to Tickle the Tyrant')
+    parser.add_argument('groups', nargs='*',
+                        help='benchmark groups to run: %s, all by default' % ', '.join(BENCHMARKS))
+    parser.add_argument('-o', '--output', help='write the results to this JSON file')
+    parser.add_argument('-c', '--compare', help='compare against the results in this JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=THRESHOLD,
+                        help='slowdown counted as regression, default %(default).2f')
+    parser.add_argument('-k', '--filter', help='only keep benchmarks whose name contains this')
+    parser.add_argument('-n', '--repeat', type=int, default=REPEAT, help='measured calls per benchmark')
+    args = parser.parse_args()
+
+    groups = args.groups or list(BENCHMARKS)
+    for group in groups:
+        if group not in BENCHMARKS:
+            parser.error('unknown benchmark group %r' % group)
+
+    results = run(groups, args.repeat, args.filter)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'processor': platform.processor(),
+                    'cpus': os.cpu_count(),
+                    'repeat': args.repeat,
+                },
+                'results': results,
+            }, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('\n%i regression(s) over %.0f%%' % (len(regressions), args.threshold * 100))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
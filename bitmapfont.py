@@ -1,10 +1,16 @@
 
+from collections import OrderedDict
+
 import pygame
 
 NUM_CHARS = 96
 TEXT_CACHING = True
+TEXT_CACHE_SIZE = 256   # rendered strings kept per font
 UPPERCASE_MODE = False
 
+# glyph atlases shared by all fonts, {(filename, font_w, font_h, zoom, colors): surface}
+glyphAtlases = {}
+
 
 class BitmapFont(object):
     def __init__(self, filename, font_w=8, font_h=8, line_h=None, colors=None, zoom=1, scr_w=320, scr_h=240):
@@ -18,23 +24,46 @@ class BitmapFont(object):
         self.scr_w = scr_w
         self.scr_h = scr_h
 
-        self.fonts = {}
-
         if not colors:
             colors = [(0, 0, 0), (255, 255, 255)]
 
         self.lastcolor = (255, 255, 255)
 
-        for c in colors:
+        self.font_w *= zoom
+        self.font_h *= zoom
+
+        # one row of glyphs per colour
+        self.atlas = self.loadAtlas(filename, font_w, font_h, zoom, tuple(colors))
+        self.rows = {c: i * self.font_h for i, c in enumerate(colors)}
+
+        self.textCache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def loadAtlas(self, filename, font_w, font_h, zoom, colors):
+        key = (str(filename), font_w, font_h, zoom, colors)
+
+        if key not in glyphAtlases:
             font = pygame.image.load(filename)
+            if pygame.display.get_surface() is not None:
+                font = font.convert_alpha()
             font = pygame.transform.scale(font, (font_w * NUM_CHARS * zoom, font_h * zoom))
-            font.fill(c, special_flags=pygame.BLEND_MULT)
-            self.fonts[c] = font
 
-        self.font_w *= zoom
-        self.font_h *= zoom
+            atlas = pygame.Surface((font.get_width(), font.get_height() * len(colors)), pygame.SRCALPHA)
+            for i, c in enumerate(colors):
+                row = font.copy()
+                row.fill(c, special_flags=pygame.BLEND_MULT)
+                atlas.blit(row, (0, i * font.get_height()), special_flags=pygame.BLEND_RGBA_MAX)
+
+            glyphAtlases[key] = atlas
 
-        self.textCache = {}
+        return glyphAtlases[key]
+
+    def glyphs(self, text, fgcolor, x, y):
+        # (atlas, pos, area) for every character, ready for Surface.blits
+        row = self.rows[fgcolor]
+        return [(self.atlas, (x + i * self.font_w, y), ((ord(c) - 32) * self.font_w, row, self.font_w, self.font_h))
+                for i, c in enumerate(text)]
 
     def drawText(self, output, text, x=None, y=None, fgcolor=None, bgcolor=None, blink=False):
         global tick
@@ -64,37 +93,35 @@ class BitmapFont(object):
 
         if TEXT_CACHING:
             key = (text, fgcolor, bgcolor)
+            cacheSurface = self.textCache.get(key)
 
-            if key not in self.textCache:
+            if cacheSurface is None:
+                self.misses += 1
                 cacheSurface = pygame.Surface((len(text) * self.font_w, self.font_h), flags=pygame.SRCALPHA)
+                cacheSurface.blits(self.glyphs(text, fgcolor, 0, 0), doreturn=False)
 
-                for i, c in enumerate(text):
-                    grabx = (ord(c) - 32) * self.font_w
-                    blitx = i * self.font_w
-                    blity = (self.font_h - self.font_h + 1) / 2
-
-                    cacheSurface.blit(self.fonts[fgcolor], (blitx, blity), (grabx, 0, self.font_w, self.font_h))
-                    self.textCache[key] = cacheSurface
+                self.textCache[key] = cacheSurface
+                if len(self.textCache) > TEXT_CACHE_SIZE:
+                    self.textCache.popitem(last=False)
             else:
-                cacheSurface = self.textCache[key]
+                self.hits += 1
+                self.textCache.move_to_end(key)
 
             blitx = x * self.font_w
             blity = y * self.line_h + 1/2
-            output.blit(cacheSurface, (blitx, blity))
+            rect = output.blit(cacheSurface, (blitx, blity))
         else:
-            for i, c in enumerate(text):
-                grabx = (ord(c) - 32) * self.font_w
-                blitx = (x + i) * self.font_w
-                blity = y * self.line_h + 1/2
-
-                output.blit(self.fonts[fgcolor], (blitx, blity), (grabx, 0, self.font_w, self.font_h))
+            rect = pygame.Rect(x * self.font_w, y * self.line_h, len(text) * self.font_w, self.font_h)
+            output.blits(self.glyphs(text, fgcolor, x * self.font_w, y * self.line_h + 1/2), doreturn=False)
 
         self.lastxpos = x
         self.lastypos = y + 1
 
+        return rect
+
     def centerText(self, output, text, y=None, fgcolor=None, bgcolor=None, blink=False):
         x = ((self.scr_w / self.font_w) - len(text)) / 2
-        self.drawText(output, text, x, y, fgcolor, bgcolor, blink)
+        return self.drawText(output, text, x, y, fgcolor, bgcolor, blink)
 
     def locate(self, x=None, y=None):
         if x is not None:
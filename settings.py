@@ -1,2 +1,4 @@
 
-FULLSCREEN = False          # opens window in fullscreen
\ No newline at end of file
+FULLSCREEN = False          # opens window in fullscreen
+FLUID_THREADS = 0           # worker threads for the wind simulation, 0 = one per core
+DIRTY_RECTS = False         # only redraw what moved while the camera and wind lines are still (slow devices)
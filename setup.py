@@ -1,5 +1,16 @@
+import sys
+
 from setuptools import setup, Extension, find_packages
 
+# the fluid kernels are parallelised with OpenMP, apple clang doesn't ship it
+# so the prange loops just run serially there
+if sys.platform == "win32":
+    openmp_args = ["/openmp"]
+elif sys.platform == "darwin":
+    openmp_args = []
+else:
+    openmp_args = ["-fopenmp"]
+
 setup(
     name="ggj2024",
     install_requires= ["pygame", "numpy"],
@@ -10,6 +21,8 @@ setup(
         Extension(
             "Fluid",
             sources=["Fluid.pyx"],
+            extra_compile_args=openmp_args,
+            extra_link_args=openmp_args if sys.platform != "win32" else [],
         ),
     ],
     #package_data = {